@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+"""Benchmarks for the boundary extraction scripts.
+
+Each benchmark writes a synthetic boundary file so no real extract is
+needed:
+
+    python bench.py ways --relations 2000
+"""
+import math
+import os
+import random
+import tempfile
+import time
+
+
+def synthetic_osm(fileobj, relations=100, ways_per_relation=8,
+                  nodes_per_way=20, seed=1):
+    """Write an .osm file with `relations` ring shaped boundaries.
+
+    Every boundary is a closed ring split into `ways_per_relation` ways,
+    some of them reversed, followed by one stray way that no relation
+    references.
+    """
+    rnd = random.Random(seed)
+    node_lines = []
+    way_lines = []
+    relation_lines = []
+    node_id = way_id = 1
+    for relation_id in range(1, relations + 1):
+        cx, cy = rnd.uniform(-170, 170), rnd.uniform(-80, 80)
+        # one changeset per boundary, as if each was mapped at once
+        meta = (' changeset="%d" user="mapper%d" uid="%d" visible="true" '
+                'timestamp="2012-%02d-01T12:00:00Z"' % (
+                    relation_id, relation_id % 50, relation_id % 50,
+                    relation_id % 12 + 1))
+        count = ways_per_relation * nodes_per_way
+        ring = []
+        for i in range(count):
+            angle = 2 * math.pi * i / count
+            radius = rnd.uniform(.5, 1.)
+            node_lines.append(' <node id="%d" version="1" lat="%.7f" '
+                              'lon="%.7f"%s/>\n' % (node_id,
+                              cy + math.sin(angle) * radius,
+                              cx + math.cos(angle) * radius,
+                              meta))
+            ring.append(node_id)
+            node_id += 1
+        ring.append(ring[0])
+        members = []
+        for i in range(ways_per_relation):
+            refs = ring[i * nodes_per_way:(i + 1) * nodes_per_way + 1]
+            if rnd.random() < .3:
+                refs.reverse()
+            way_lines.append(' <way id="%d" version="1"%s>\n'
+                             % (way_id, meta))
+            way_lines.extend('  <nd ref="%d"/>\n' % ref for ref in refs)
+            way_lines.append('  <tag k="boundary" v="administrative"/>\n'
+                             ' </way>\n')
+            members.append(way_id)
+            way_id += 1
+        way_lines.append(' <way id="%d" version="1">\n  <nd ref="%d"/>\n'
+                         '  <nd ref="%d"/>\n </way>\n' % (way_id, ring[0],
+                                                          ring[1]))
+        way_id += 1
+        rnd.shuffle(members)
+        relation_lines.append(' <relation id="%d" version="1">\n'
+                              % relation_id)
+        relation_lines.extend('  <member type="way" ref="%d" role="outer"/>\n'
+                              % member for member in members)
+        relation_lines.append('  <tag k="boundary" v="administrative"/>\n'
+                              '  <tag k="admin_level" v="%d"/>\n'
+                              '  <tag k="NAME" v="Country %d"/>\n'
+                              ' </relation>\n' % (rnd.choice((2, 4, 6, 8)),
+                                                  relation_id))
+    fileobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<osm version="0.6" generator="bench.py">\n')
+    fileobj.writelines(node_lines)
+    fileobj.writelines(way_lines)
+    fileobj.writelines(relation_lines)
+    fileobj.write('</osm>\n')
+
+
+def synthetic_file(args, relations=None):
+    fd, filename = tempfile.mkstemp(suffix='.osm')
+    with os.fdopen(fd, 'w') as fileobj:
+        synthetic_osm(fileobj, relations or args.relations, args.ways,
+                      args.nodes)
+    return filename
+
+
+def report(name, count, unit, seconds):
+    print('%-24s %10d %s in %8.3fs  %12.0f %s/sec' % (
+        name, count, unit, seconds, count / max(seconds, 1e-9), unit))
+
+
+def legacy_generate_ways(parser):
+    """generate_ways as it was before the way -> relation index."""
+    for i, way_id in enumerate(parser.way_ids):
+        nodes = []
+        for ref in parser.way_refs[parser.way_offsets[i]:
+                                   parser.way_offsets[i + 1]]:
+            if ref in parser.border_nodes:
+                nodes.append(parser.border_nodes[ref])
+        for relation_id, members in parser.relations_ways.items():
+            if way_id in members:
+                for country in parser.countries_data:
+                    if country['properties']['id'] == relation_id:
+                        country['geometry']['coordinates'].append(nodes)
+                        country['properties']['count'] += len(nodes)
+
+
+def bench_ways(args):
+    """ways/sec of parser.generate_ways with and without the index."""
+    import parser
+    filename = synthetic_file(args)
+    try:
+        runs = (('generate_ways (legacy)',
+                 lambda: legacy_generate_ways(parser)),
+                ('generate_ways', lambda: parser.generate_ways()))
+        for name, func in runs:
+            parser = reload(parser)
+            parser.generate(filename)
+            for country in parser.countries_data:
+                del country['geometry']['coordinates'][:]
+                country['properties']['count'] = 0
+            start = time.time()
+            func()
+            report(name, len(parser.way_ids), 'ways', time.time() - start)
+    finally:
+        os.remove(filename)
+
+
+def bench_filter(args):
+    """relations/sec of parser.generate reading only boundary nodes, with
+    and without a relation filter expression, and the nodes each keeps."""
+    import parser
+    filename = synthetic_file(args)
+    try:
+        for name, expression in (
+                ('generate', None),
+                ('generate (admin_level<=4)',
+                 'boundary=administrative and admin_level<=4')):
+            parser = reload(parser)
+            start = time.time()
+            parser.generate(filename, needed_only=True,
+                            relation_expression=expression)
+            report(name, args.relations, 'relations', time.time() - start)
+            print('%s: %d features, %d nodes' % (
+                name, len(parser.countries_data), len(parser.border_nodes)))
+    finally:
+        os.remove(filename)
+
+
+def synthetic_change(fileobj, filename, relations, ways_per_relation,
+                     nodes_per_way, seed=1):
+    """Write an .osc moving one node of each of `relations` boundaries of
+    the synthetic_osm() file `filename`, as numbered there."""
+    from lxml import etree
+    moved = set()
+    rnd = random.Random(seed)
+    for relation_id in relations:
+        first = (relation_id - 1) * ways_per_relation * nodes_per_way + 1
+        moved.add(first + rnd.randrange(ways_per_relation * nodes_per_way))
+    fileobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<osmChange version="0.6">\n<modify>\n')
+    for action, elem in etree.iterparse(filename, tag='node'):
+        if int(elem.get('id')) in moved:
+            fileobj.write(' <node id="%s" version="2" lat="%.7f" lon="%s"/>\n'
+                          % (elem.get('id'), float(elem.get('lat')) + .01,
+                             elem.get('lon')))
+        elem.clear()
+    fileobj.write('</modify>\n</osmChange>\n')
+
+
+def bench_update(args):
+    """seconds of a full parser2.py build keeping its state, and of
+    applying a change to one boundary in a hundred to that state."""
+    import shutil
+    import subprocess
+    import sys
+    import parser2
+    filename = synthetic_file(args)
+    directory = tempfile.mkdtemp()
+    try:
+        output = os.path.join(directory, 'out.json')
+        state = os.path.join(directory, 'state')
+        start = time.time()
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'parser2.py')
+        subprocess.check_call([sys.executable, script, '--src', filename,
+                               '--dst', output, '--no-cache', '--state',
+                               state])
+        report('full build', args.relations, 'relations',
+               time.time() - start)
+        change = os.path.join(directory, 'change.osc')
+        with open(change, 'w') as fileobj:
+            synthetic_change(fileobj, filename,
+                             range(1, args.relations + 1, 100), args.ways,
+                             args.nodes)
+        start = time.time()
+        parser2.update(state, [change], output)
+        report('apply diff', args.relations, 'relations',
+               time.time() - start)
+    finally:
+        os.remove(filename)
+        shutil.rmtree(directory)
+
+
+def synthetic_ring(segments, points=4, gap=0, seed=1):
+    """A circle of radius 100 cut into `segments` shuffled, partly
+    reversed ways of `points` + 1 nodes.
+
+    With a `gap` (in radians) consecutive ways do not share a node: each
+    way ends on its own node, that much short of the next way's start.
+    Returns (ways, nodes).
+    """
+    rnd = random.Random(seed)
+    count = segments * points
+    nodes = {}
+    ways = []
+    for i in range(segments):
+        way = []
+        for k in range(i * points, (i + 1) * points + 1):
+            angle = 2 * math.pi * k / count
+            if gap:
+                node_id = len(nodes)
+                if k == (i + 1) * points:
+                    angle -= gap
+            else:
+                node_id = k % count
+            nodes[node_id] = (math.cos(angle) * 100, math.sin(angle) * 100)
+            way.append(node_id)
+        if rnd.random() < .5:
+            way.reverse()
+        ways.append(way)
+    rnd.shuffle(ways)
+    return ways, nodes
+
+
+def bench_rings(args):
+    """segments/sec of rings.assemble, joining on shared nodes and
+    snapping ends across small gaps."""
+    import rings
+    segments = args.relations * args.ways
+    for name, gap, tolerance in (('assemble', 0, 0),
+                                 ('assemble (snapping)', 1e-7, 1e-4)):
+        ways, nodes = synthetic_ring(segments, gap=gap)
+        start = time.time()
+        closed, unclosed = rings.assemble(ways, nodes, tolerance)
+        report(name, segments, 'segments', time.time() - start)
+        assert len(closed) == 1 and not unclosed
+
+
+def bench_compressed(args):
+    """primitives/sec of osmread.read on a synthetic file, plain and
+    compressed, decompressing first and then parsing, and while parsing
+    (in the background, multi-stream bzip2 in parallel)."""
+    import bz2
+    import gzip
+    from StringIO import StringIO
+    import compression
+    import osmread
+    filename = synthetic_file(args)
+    outputs = []
+    try:
+        with open(filename, 'rb') as fileobj:
+            content = fileobj.read()
+        with gzip.open(filename + '.gz', 'wb') as fileobj:
+            fileobj.write(content)
+        outputs.append(filename + '.gz')
+        # 900 KB a stream, as pbzip2 cuts them
+        with open(filename + '.bz2', 'wb') as fileobj:
+            for i in range(0, len(content), 900000):
+                fileobj.write(bz2.compress(content[i:i + 900000]))
+        outputs.append(filename + '.bz2')
+        count = sum(1 for primitive in osmread.read(filename))
+        start = time.time()
+        for primitive in osmread.read(filename):
+            pass
+        report('read .osm', count, 'primitives', time.time() - start)
+        for output in outputs:
+            ext = os.path.splitext(output)[1]
+            start = time.time()
+            with open(output, 'rb') as raw:
+                decompressor = {'.gz': compression.gzip_decompressor,
+                                '.bz2': bz2.BZ2Decompressor}[ext]
+                data = ''.join(compression.decompressed_blocks(raw,
+                                                               decompressor))
+            for primitive in osmread.read_xml(StringIO(data)):
+                pass
+            report('read %s (serial)' % ext, count, 'primitives',
+                   time.time() - start)
+            start = time.time()
+            for primitive in osmread.read(output):
+                pass
+            report('read %s' % ext, count, 'primitives', time.time() - start)
+    finally:
+        os.remove(filename)
+        for output in outputs:
+            os.remove(output)
+
+
+def bench_dp(args):
+    """points/sec of dp.simplify_indices in pure Python and with NumPy on
+    large noisy rings."""
+    import dp
+    rnd = random.Random(1)
+    ways, nodes = synthetic_ring(args.relations * args.ways, args.nodes)
+    ring = [(x + rnd.gauss(0, .01), y + rnd.gauss(0, .01))
+            for x, y in (nodes[node_id] for node_id in sorted(nodes))]
+    ring.append(ring[0])
+    runs = [('simplify_indices_python', dp.simplify_indices_python)]
+    if dp.numpy is not None:
+        runs.append(('simplify_indices_numpy', dp.simplify_indices_numpy))
+    for tolerance in (.15, .01):
+        results = []
+        for name, func in runs:
+            start = time.time()
+            results.append(func(ring, tolerance))
+            report('%s %s' % (name, tolerance), len(ring), 'points',
+                   time.time() - start)
+        assert all(len(result) == len(results[0]) for result in results)
+
+
+def synthetic_features(relations, points, seed=1):
+    """A GeoJSON feature collection of `relations` noisy, ring shaped
+    polygons of `points` points."""
+    rnd = random.Random(seed)
+    features = []
+    for relation_id in range(1, relations + 1):
+        cx, cy = rnd.uniform(-170, 170), rnd.uniform(-80, 80)
+        ring = []
+        for i in range(points):
+            angle = 2 * math.pi * i / points
+            radius = rnd.uniform(5, 10)
+            ring.append([cx + math.cos(angle) * radius,
+                         cy + math.sin(angle) * radius])
+        ring.append(ring[0])
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [ring]},
+                         'properties': {'id': relation_id}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def bench_simplify(args):
+    """points/sec of simplify.simplify in one process and in one per
+    CPU."""
+    import simplify
+    from multiprocessing import cpu_count
+    points = args.ways * args.nodes
+    results = []
+    for jobs in sorted(set((1, max(cpu_count(), 2)))):
+        data = synthetic_features(args.relations, points)
+        start = time.time()
+        simplify.simplify(data['features'], .01, jobs)
+        report('simplify (%d jobs)' % jobs, args.relations * (points + 1),
+               'points', time.time() - start)
+        results.append(data)
+    assert all(result == results[0] for result in results)
+
+
+def bench_formats(args):
+    """points/sec writing and reading GeoJSON, newline delimited GeoJSON
+    and geobin, and the size of each."""
+    import geojsonio
+    data = synthetic_features(args.relations, args.ways * args.nodes)
+    points = args.relations * (args.ways * args.nodes + 1)
+    for suffix in ('.json', '.ndjson', '.geobin'):
+        fd, filename = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            start = time.time()
+            geojsonio.write(filename, data['features'], 7)
+            report('write %s' % suffix, points, 'points', time.time() - start)
+            start = time.time()
+            for feature in geojsonio.read(filename):
+                pass
+            report('read %s' % suffix, points, 'points', time.time() - start)
+            print('%s: %d bytes' % (suffix, os.path.getsize(filename)))
+        finally:
+            os.remove(filename)
+
+
+def rss():
+    """Resident memory of this process in bytes (its peak where there is
+    no /proc)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_osm(task):
+    """Memory taken by pyosm.OSMXMLFile(filename, options=options), and
+    the number of objects loaded."""
+    import gc
+    import pyosm
+    filename, options = task
+    gc.collect()
+    before = rss()
+    osm = pyosm.OSMXMLFile(filename, options=options)
+    gc.collect()
+    return rss() - before, len(osm.nodes) + len(osm.ways) + len(osm.relations)
+
+
+def bench_memory(args):
+    """Memory pyosm takes for a file, with plain, compact and column
+    stored objects, each loaded in a fresh process."""
+    from multiprocessing import Pool
+    filename = synthetic_file(args)
+    try:
+        for name, options in (('pyosm', {}),
+                              ('pyosm (compact)', {'compact': True}),
+                              ('pyosm (columns)', {'columns': True}),
+                              ('pyosm (columns, no way nodes)',
+                               {'columns': True, 'load_way_nodes': False}),
+                              ('pyosm (projected)',
+                               {'keep_attributes': (),
+                                'keep_tags': ('NAME', 'admin_level',
+                                              'boundary')})):
+            pool = Pool(1)
+            try:
+                size, count = pool.apply(load_osm, ((filename, options), ))
+            finally:
+                pool.close()
+                pool.join()
+            print('%-32s %8.1f MB %8.0f bytes/object' % (
+                name, size / 1e6, size / float(max(count, 1))))
+    finally:
+        os.remove(filename)
+
+
+def bench_parse(args):
+    """elements/sec of pyosm.OSMXMLFile with each engine, and projected
+    to what boundaries need, on files of a quarter, once and four times
+    --relations boundaries."""
+    import pyosm
+    for relations in (max(args.relations // 4, 1), args.relations,
+                      args.relations * 4):
+        filename = synthetic_file(args, relations)
+        try:
+            with open(filename, 'rb') as fileobj:
+                content = fileobj.read()
+            elements = (content.count('<') - content.count('</') -
+                        content.count('<?'))
+            runs = [(engine, {'engine': engine})
+                    for engine in sorted(pyosm.ENGINES)]
+            # only what boundary extraction needs
+            runs.append(('projected', {
+                'keep_attributes': (),
+                'keep_tags': ('NAME', 'admin_level', 'boundary'),
+                'tagfilter': lambda name, tags: (
+                    name == 'node' or 'boundary' in tags)}))
+            for name, options in runs:
+                start = time.time()
+                pyosm.OSMXMLFile(filename, options=options)
+                report('pyosm %s (%d)' % (name, relations), elements,
+                       'elements', time.time() - start)
+        finally:
+            os.remove(filename)
+
+
+def legacy_merge(osm, other):
+    """OSMXMLFile.merge as it was before it resolved only what changed."""
+    get_member = osm._OSMXMLFile__get_member
+    for node in other.nodes.values():
+        osm.nodes[node.id] = node
+    for way in other.ways.values():
+        osm.ways[way.id] = way
+    for relation in other.relations.values():
+        osm.relations[relation.id] = relation
+    for way in osm.ways.values():
+        if hasattr(way, 'nodes') and hasattr(way, 'version'):
+            way.nodes = [get_member(node.id, 'node') for node in way.nodes]
+    for relation in osm.relations.values():
+        if hasattr(relation, 'members') and hasattr(relation, 'version'):
+            relation.members = [(get_member(obj.id, obj.TYPE), role)
+                                if hasattr(obj, 'version') else (obj, role)
+                                for obj, role in relation.members]
+
+
+def synthetic_extracts(args, count):
+    """Split a synthetic file into `count` sorted extracts of consecutive
+    ids, like per-region extracts: a few ways and relations refer to
+    objects of the next extract."""
+    import pyosm
+    filename = synthetic_file(args)
+    try:
+        osm = pyosm.OSMXMLFile(filename)
+    finally:
+        os.remove(filename)
+    filenames = []
+    for i in range(count):
+        fd, filename = tempfile.mkstemp(suffix='.osm')
+        os.close(fd)
+        objects = []
+        for kind in (osm.nodes, osm.ways, osm.relations):
+            ids = sorted(kind)
+            objects.extend(kind[obj_id] for obj_id in
+                           ids[len(ids) * i // count:
+                               len(ids) * (i + 1) // count])
+        pyosm.write_objects(objects, filename)
+        filenames.append(filename)
+    return filenames
+
+
+def bench_merge(args):
+    """objects/sec merging 20 extracts into one OSMXMLFile, one after the
+    other, before and after resolving only what changed, and streaming
+    them into one sorted file."""
+    import pyosm
+    filenames = synthetic_extracts(args, 20)
+    try:
+        extracts = [pyosm.OSMXMLFile(filename) for filename in filenames]
+        count = sum(len(osm.nodes) + len(osm.ways) + len(osm.relations)
+                    for osm in extracts)
+        for name, merge in (('merge (legacy)', legacy_merge),
+                            ('merge', pyosm.OSMXMLFile.merge)):
+            osm = pyosm.OSMXMLFile()
+            start = time.time()
+            for extract in extracts:
+                merge(osm, extract)
+            report(name, count, 'objects', time.time() - start)
+        fd, output = tempfile.mkstemp(suffix='.osm')
+        os.close(fd)
+        try:
+            start = time.time()
+            written = pyosm.merge_sorted(filenames, output)
+            report('merge_sorted', written, 'objects', time.time() - start)
+        finally:
+            os.remove(output)
+    finally:
+        for filename in filenames:
+            os.remove(filename)
+
+
+def legacy_write(osm, fileobj):
+    """OSMXMLFile.write as it was, an XMLGenerator call per element."""
+    from xml.sax.saxutils import XMLGenerator
+    handler = XMLGenerator(fileobj, 'UTF-8')
+    handler.startDocument()
+    handler.startElement('osm', osm.osmattrs)
+    handler.characters('\n')
+    for objects in (osm.nodes, osm.ways, osm.relations):
+        for obj_id in sorted(objects):
+            obj = objects[obj_id]
+            if not hasattr(obj, 'version'):
+                continue
+            handler.startElement(obj.TYPE, obj.attributes())
+            for node in getattr(obj, 'nodes', ()):
+                handler.characters('  ')
+                handler.startElement('nd', {'ref': str(node.id)})
+                handler.endElement('nd')
+                handler.characters('\n')
+            for member, role in getattr(obj, 'members', ()):
+                handler.characters('  ')
+                handler.startElement('member', {'type': member.TYPE,
+                                                'ref': str(member.id),
+                                                'role': role})
+                handler.endElement('member')
+                handler.characters('\n')
+            for name, value in obj.tags.items():
+                handler.characters('  ')
+                handler.startElement('tag', {'k': name, 'v': value})
+                handler.endElement('tag')
+                handler.characters('\n')
+            handler.endElement(obj.TYPE)
+            handler.characters('\n')
+    handler.endElement('osm')
+    handler.endDocument()
+
+
+def bench_write(args):
+    """objects/sec writing a parsed file with the XMLGenerator writer and
+    OSMXMLFile.write, plain, gzip and bzip2 compressed, and streaming it
+    from pyosm.iterparse, and the size of each output."""
+    import pyosm
+    filename = synthetic_file(args)
+    try:
+        osm = pyosm.OSMXMLFile(filename)
+        count = sum(1 for objects in (osm.nodes, osm.ways, osm.relations)
+                    for obj in objects.values()
+                    if isinstance(obj, pyosm.OSMObject))
+        def legacy(output):
+            with open(output, 'wb') as fileobj:
+                legacy_write(osm, fileobj)
+        runs = [('write (legacy)', '.osm', legacy)]
+        for suffix in ('.osm', '.osm.gz', '.osm.bz2'):
+            runs.append(('write %s' % suffix, suffix, osm.write))
+        runs.append(('write_objects(iterparse)', '.osm',
+                     lambda output: pyosm.write_objects(
+                         pyosm.iterparse(filename), output)))
+        for name, suffix, write in runs:
+            fd, output = tempfile.mkstemp(suffix=suffix)
+            os.close(fd)
+            try:
+                start = time.time()
+                write(output)
+                report(name, count, 'objects', time.time() - start)
+                print('%s: %d bytes' % (name, os.path.getsize(output)))
+            finally:
+                os.remove(output)
+    finally:
+        os.remove(filename)
+
+
+BENCHMARKS = {
+    'compressed': bench_compressed,
+    'dp': bench_dp,
+    'filter': bench_filter,
+    'formats': bench_formats,
+    'memory': bench_memory,
+    'merge': bench_merge,
+    'parse': bench_parse,
+    'rings': bench_rings,
+    'simplify': bench_simplify,
+    'update': bench_update,
+    'ways': bench_ways,
+    'write': bench_write,
+}
+
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="""Run benchmarks on
+    synthetic boundary data.""")
+    arg_parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                            help='One of: %s (default: all).'
+                            % ', '.join(sorted(BENCHMARKS)))
+    arg_parser.add_argument('--relations', type=int, default=500,
+                            help='Number of synthetic boundary relations.')
+    arg_parser.add_argument('--ways', type=int, default=8,
+                            help='Ways per boundary relation.')
+    arg_parser.add_argument('--nodes', type=int, default=20,
+                            help='Nodes per way.')
+    args = arg_parser.parse_args()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
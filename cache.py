@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Versioned cache of the nodes, ways and relations parsed from a source.
+
+Every entry is a directory named after a key derived from the source's
+absolute path, size, modification time and a hash of its content, so a
+different or modified source never hits a stale entry:
+
+    meta.json       cache version and what the entry was built from
+    nodes.arr       node ids, lons and lats (sharedarray format)
+    ways.arr        way ids, offsets and refs (sharedarray format)
+    relations.json  the relations dict
+
+The array files are memory-mapped on load, so a warm run only pages in
+what it touches, and each of the three parts loads separately.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from array import array
+import simplejson as json
+import nodestore
+import sharedarray
+
+VERSION = 2
+# Hashing a planet file would take as long as parsing it; hash this many
+# bytes from its start, middle and end instead.
+SAMPLE = 1024 * 1024
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'parser2-cache')
+
+
+def content_hash(filename, size):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fileobj:
+        for offset in sorted(set((0, max(size // 2 - SAMPLE // 2, 0),
+                                  max(size - SAMPLE, 0)))):
+            fileobj.seek(offset)
+            digest.update(fileobj.read(SAMPLE))
+    return digest.hexdigest()
+
+
+def source_key(filename, params=None):
+    """Key of the current state of `filename`, parsed with `params`."""
+    stat = os.stat(filename)
+    source = {'path': os.path.abspath(filename), 'size': stat.st_size,
+              'mtime': stat.st_mtime,
+              'hash': content_hash(filename, stat.st_size)}
+    key = json.dumps({'version': VERSION, 'source': source,
+                      'params': params or {}}, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest(), source
+
+
+def dump_nodes(filename, nodes):
+    """Dump any node store as SortedNodeStore arrays. Returns whether its
+    ids came sorted, which load_nodes() needs back."""
+    sorted_nodes = nodestore.SortedNodeStore()
+    nodestore.merge(sorted_nodes, nodes)
+    sharedarray.dump(filename, sorted_nodes.arrays())
+    return sorted_nodes.sorted
+
+
+def dump_ways(filename, ways):
+    """Dump a ways dict as flat arrays."""
+    way_ids = array('l')
+    way_offsets = array('l', [0])
+    way_refs = array('l')
+    for way_id, refs in ways.iteritems():
+        way_ids.append(way_id)
+        way_refs.extend(refs)
+        way_offsets.append(len(way_refs))
+    sharedarray.dump(filename, (way_ids, way_offsets, way_refs))
+
+
+def dump_relations(filename, relations):
+    with open(filename, 'wb') as fileobj:
+        json.dump(relations, fileobj)
+
+
+def load_nodes(filename, nodes_sorted):
+    """A read-only SortedNodeStore mapping the arrays dump_nodes() wrote."""
+    ids, lons, lats = sharedarray.attach(filename)
+    return nodestore.SortedNodeStore.from_arrays(ids, lons, lats,
+                                                 nodes_sorted)
+
+
+def load_ways(filename):
+    way_ids, way_offsets, way_refs = sharedarray.attach(filename)
+    ways = {}
+    for i, way_id in enumerate(way_ids):
+        ways[way_id] = way_refs[way_offsets[i]:way_offsets[i + 1]]
+    return ways
+
+
+def load_relations(filename):
+    with open(filename, 'rb') as fileobj:
+        return dict((int(relation_id), relation) for relation_id, relation
+                    in json.load(fileobj).iteritems())
+
+
+class Cache(object):
+    def __init__(self, src, directory=DEFAULT_DIR, params=None):
+        self.src = src
+        self.directory = directory
+        self.params = params or {}
+        self.key, self.source = source_key(src, params)
+        self.path = os.path.join(directory, self.key)
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        try:
+            with open(self.filename('meta.json'), 'rb') as fileobj:
+                meta = json.load(fileobj)
+        except (IOError, ValueError):
+            return False
+        return meta.get('version') == VERSION
+
+    def clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def prune(self):
+        """Remove the entries of older states of the same source parsed
+        with the same parameters."""
+        for key in os.listdir(self.directory):
+            meta = os.path.join(self.directory, key, 'meta.json')
+            try:
+                with open(meta, 'rb') as fileobj:
+                    meta = json.load(fileobj)
+                path = meta['source']['path']
+            except (IOError, ValueError, KeyError):
+                continue
+            if (key != self.key and path == self.source['path'] and
+                    meta.get('params', {}) == self.params):
+                shutil.rmtree(os.path.join(self.directory, key))
+
+    def save(self, nodes, ways, relations):
+        """Store a node store, ways dict and relations dict. The entry is
+        built next to its final place and renamed, so readers never see a
+        half written one."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        building = tempfile.mkdtemp(prefix=self.key, dir=self.directory)
+        try:
+            nodes_sorted = dump_nodes(os.path.join(building, 'nodes.arr'),
+                                      nodes)
+            dump_ways(os.path.join(building, 'ways.arr'), ways)
+            dump_relations(os.path.join(building, 'relations.json'),
+                           relations)
+            with open(os.path.join(building, 'meta.json'), 'wb') as f:
+                json.dump({'version': VERSION, 'source': self.source,
+                           'params': self.params,
+                           'sorted': nodes_sorted}, f)
+            self.clear()
+            os.rename(building, self.path)
+            self.prune()
+        except Exception:
+            shutil.rmtree(building)
+            raise
+
+    def load_nodes(self):
+        """A read-only SortedNodeStore mapping the cached node arrays."""
+        with open(self.filename('meta.json'), 'rb') as fileobj:
+            nodes_sorted = json.load(fileobj)['sorted']
+        return load_nodes(self.filename('nodes.arr'), nodes_sorted)
+
+    def load_ways(self):
+        return load_ways(self.filename('ways.arr'))
+
+    def load_relations(self):
+        return load_relations(self.filename('relations.json'))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""Files compressed according to their extension.
+
+open_output() compresses .gz and .bz2 outputs in a background thread,
+through a bounded queue of blocks, so serialization and compression
+overlap: zlib and bz2 release the GIL while they work.
+
+open_input() reads .gz, .bz2 and .xz inputs the same way, decompressed
+in a background thread at most DEPTH blocks ahead of the reader.
+Multi-stream bz2 files (as pbzip2 writes them) are cut at stream starts
+into chunks of about CHUNK bytes that a pool of threads decompresses in
+parallel, at most two per thread ahead. Without an lzma module .xz is
+decompressed by an xz process.
+"""
+import bz2
+import gzip
+import os
+import re
+import subprocess
+import threading
+import zlib
+import Queue
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+EXTENSIONS = ('.gz', '.bz2', '.xz')
+# blocks waiting to be compressed or read, at most
+DEPTH = 8
+# bytes of compressed input read at once
+BLOCK = 1024 * 1024
+# compressed bytes of multi-stream bz2 decompressed by one thread at once
+CHUNK = 1024 * 1024
+# the start of a bz2 stream: magic, block size and first block's magic
+BZ2_STREAM = re.compile(r'BZh[1-9]1AY&SY')
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in EXTENSIONS
+
+
+def base_name(filename):
+    """`filename` without its compression extension, to tell its format
+    by: 'planet.osm.bz2' -> 'planet.osm'."""
+    if is_compressed(filename):
+        return os.path.splitext(filename)[0]
+    return filename
+
+
+def compressed_file(filename, mode):
+    """The gzip or bz2 file object for `filename` if its extension asks
+    for one, else None."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        return gzip.open(filename, mode)
+    if ext == '.bz2':
+        return bz2.BZ2File(filename, mode)
+    return None
+
+
+class BackgroundWriter(object):
+    """A write-only file object handing what is written to `target` in a
+    thread of its own. close() waits for it, closes `target` and raises
+    whatever the thread failed with."""
+    def __init__(self, target, depth=DEPTH):
+        self.target = target
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            # after a failure keep taking blocks, so write() never blocks
+            if self.error is None:
+                try:
+                    self.target.write(data)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.target.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_output(filename):
+    """A file object writing to `filename`, compressed in a background
+    thread if it ends in .gz or .bz2."""
+    target = compressed_file(filename, 'wb')
+    if target is None:
+        return open(filename, 'wb')
+    return BackgroundWriter(target)
+
+
+def decompressed_blocks(raw, new_decompressor):
+    """Yield the decompressed blocks of the file object `raw`, one or more
+    concatenated streams, each decompressed by a new_decompressor()."""
+    decompressor = new_decompressor()
+    for data in iter(lambda: raw.read(BLOCK), ''):
+        while data:
+            try:
+                block = decompressor.decompress(data)
+            except EOFError:
+                # the stream ended right at the end of the previous data
+                decompressor = new_decompressor()
+                continue
+            if block:
+                yield block
+            # only there once a stream ended within the data
+            data = decompressor.unused_data
+            if data:
+                decompressor = new_decompressor()
+    if hasattr(decompressor, 'flush'):
+        block = decompressor.flush()
+        if block:
+            yield block
+
+
+def gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def bz2_chunks(raw, size=CHUNK):
+    """Cut the bz2 file object `raw` at stream starts into (offset, data)
+    chunks of about `size` bytes. A chunk with no stream start within
+    4 * `size` bytes comes as (offset, None), and the cutting stops.
+
+    A stream start is only likely: compressed data may contain the same
+    bytes, which decompress_streams() finds out."""
+    offset = 0
+    data = raw.read(size)
+    while data:
+        match = BZ2_STREAM.search(data, size)
+        while match is None:
+            if len(data) > 4 * size:
+                yield offset, None
+                return
+            more = raw.read(BLOCK)
+            if not more:
+                break
+            # a stream start may straddle the old end of the data
+            searched = max(size, len(data) - 9)
+            data += more
+            match = BZ2_STREAM.search(data, searched)
+        if match is None:
+            yield offset, data
+            return
+        yield offset, data[:match.start()]
+        offset += match.start()
+        data = data[match.start():]
+
+
+def decompress_streams(data):
+    """The decompressed bz2 streams of `data`, and whether they were
+    whole: False if data does not end with the end of a stream."""
+    decompressor = bz2.BZ2Decompressor()
+    blocks = []
+    try:
+        while data:
+            blocks.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+        decompressor.decompress('')
+    except EOFError:
+        return ''.join(blocks), True
+    except IOError:
+        pass
+    return ''.join(blocks), False
+
+
+def parallel_bz2_blocks(raw, jobs):
+    """Yield the decompressed blocks of the bz2 file object `raw`,
+    decompressing its streams in `jobs` threads. Carries on serially from
+    a chunk that was not cut at a real stream start."""
+    pool = ThreadPool(jobs)
+    pending = deque()
+    serial_from = None
+    try:
+        for chunk in bz2_chunks(raw):
+            offset, data = chunk
+            if data is None:
+                serial_from = offset
+                break
+            pending.append((offset, pool.apply_async(decompress_streams,
+                                                     (data, ))))
+            while len(pending) > 2 * jobs:
+                offset, result = pending.popleft()
+                data, whole = result.get()
+                if not whole:
+                    serial_from = offset
+                    break
+                yield data
+            if serial_from is not None:
+                break
+        while pending and serial_from is None:
+            offset, result = pending.popleft()
+            data, whole = result.get()
+            if not whole:
+                serial_from = offset
+                break
+            yield data
+    finally:
+        pool.close()
+        pool.join()
+    if serial_from is not None:
+        raw.seek(serial_from)
+        for block in decompressed_blocks(raw, bz2.BZ2Decompressor):
+            yield block
+
+
+class BackgroundReader(object):
+    """A read-only file object over the blocks of the iterable `blocks`,
+    iterated in a thread of its own at most `depth` blocks ahead. `raw`,
+    the file the blocks come from, is closed by close()."""
+    def __init__(self, blocks, raw, depth=DEPTH):
+        self.raw = raw
+        self.queue = Queue.Queue(depth)
+        self.pieces = deque()
+        # read up to there in the first piece
+        self.offset = 0
+        self.buffered = 0
+        self.eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, args=(blocks, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, blocks):
+        try:
+            for block in blocks:
+                self.queue.put(block)
+                if self.stopped:
+                    return
+        except Exception as error:
+            self.queue.put(error)
+        else:
+            self.queue.put(None)
+
+    def fill(self):
+        item = self.queue.get()
+        if item is None:
+            self.eof = True
+        elif isinstance(item, Exception):
+            self.eof = True
+            raise item
+        else:
+            self.pieces.append(item)
+            self.buffered += len(item)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or self.buffered < size):
+            self.fill()
+        if size < 0 or size > self.buffered:
+            size = self.buffered
+        parts = []
+        left = size
+        while left:
+            piece = self.pieces[0]
+            end = min(self.offset + left, len(piece))
+            parts.append(piece[self.offset:end])
+            left -= end - self.offset
+            self.offset = end
+            if end == len(piece):
+                self.pieces.popleft()
+                self.offset = 0
+        self.buffered -= size
+        return ''.join(parts)
+
+    def close(self):
+        self.stopped = True
+        # let the thread put what it is putting and see it is stopped
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=.1)
+            except Queue.Empty:
+                pass
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProcessReader(object):
+    """A read-only file object over the output of a decompressing
+    process."""
+    def __init__(self, args):
+        self.args = args
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        # killed by SIGPIPE when closed before the end, which is fine
+        if self.process.wait() not in (0, -13):
+            raise IOError("%s failed" % ' '.join(self.args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_input(filename, jobs=None):
+    """A file object reading `filename`, decompressed in the background
+    if it ends in .gz, .bz2 or .xz; multi-stream bz2 in `jobs` threads
+    (default: one per CPU)."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in EXTENSIONS:
+        return open(filename, 'rb')
+    if ext == '.xz' and lzma is None:
+        return ProcessReader(['xz', '-dc', filename])
+    raw = open(filename, 'rb')
+    if jobs is None:
+        jobs = cpu_count()
+    if ext == '.gz':
+        blocks = decompressed_blocks(raw, gzip_decompressor)
+    elif ext == '.xz':
+        blocks = decompressed_blocks(raw, lzma.LZMADecompressor)
+    elif jobs > 1:
+        blocks = parallel_bz2_blocks(raw, jobs)
+    else:
+        blocks = decompressed_blocks(raw, bz2.BZ2Decompressor)
+    return BackgroundReader(blocks, raw)
@@ -14,16 +14,47 @@
 >>> line = [(0,0),(1,0),(2,0),(2,1),(2,2),(1,2),(0,2),(0,1),(0,0)]
 >>> simplify_points(line, 1.0)
 [(0, 0), (2, 0), (2, 2), (0, 2), (0, 0)]
+>>> simplify_indices(line, 1.0) == simplify_indices_numpy(line, 1.0)
+True
 
 >>> line = [(0,0),(0.5,0.5),(1,0),(1.25,-0.25),(1.5,.5)]
 >>> simplify_points(line, 0.25)
 [(0, 0), (0.5, 0.5), (1.25, -0.25), (1.5, 0.5)]
+>>> simplify_indices(line, 0.25), simplify_indices_numpy(line, 0.25)
+([0, 1, 3, 4], [0, 1, 3, 4])
+>>> [round(value, 3) for value in significance(line)]
+[inf, 0.588, 0.0, 0.632, inf]
 
 """
 
 import math
-   
-def simplify_points (pts, tolerance): 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this many points the NumPy version's per span overhead costs more
+# than the pure-Python loop.
+NUMPY_MIN_POINTS = 64
+
+def simplify_points (pts, tolerance):
+    return [pts[i] for i in simplify_indices(pts, tolerance)]
+
+def simplify_indices (pts, tolerance):
+    """Sorted indices of the points kept, found with NumPy if it is
+    installed and the line is long enough to benefit, in pure Python
+    otherwise."""
+    if numpy is not None and len(pts) >= NUMPY_MIN_POINTS:
+        return simplify_indices_numpy(pts, tolerance)
+    return simplify_indices_python(pts, tolerance)
+
+def simplify_indices_python (pts, tolerance):
+    return douglas_peucker(pts, tolerance, farthest_python(pts))
+
+def simplify_indices_numpy (pts, tolerance):
+    return douglas_peucker(pts, tolerance, farthest_numpy(pts))
+
+def douglas_peucker (pts, tolerance, farthest_point):
     anchor  = 0
     floater = len(pts) - 1
     stack   = []
@@ -32,7 +63,47 @@ def simplify_points (pts, tolerance):
     stack.append((anchor, floater))  
     while stack:
         anchor, floater = stack.pop()
-      
+        max_dist, farthest = farthest_point(anchor, floater)
+
+        if max_dist <= tolerance: # use line segment
+            keep.add(anchor)
+            keep.add(floater)
+        else:
+            stack.append((anchor, farthest))
+            stack.append((farthest, floater))
+
+    keep = list(keep)
+    keep.sort()
+    return keep
+
+def significance (pts):
+    """The tolerance at which each point drops out of the simplified line:
+    simplify_indices(pts, tolerance) keeps exactly the points whose
+    significance is above tolerance. The ends never drop out.
+
+    A point is split on only while all the spans it lies in are, so its
+    significance is its distance capped by that of the split before it.
+    """
+    if numpy is not None and len(pts) >= NUMPY_MIN_POINTS:
+        farthest_point = farthest_numpy(pts)
+    else:
+        farthest_point = farthest_python(pts)
+    result = [0.0] * len(pts)
+    result[0] = result[-1] = float('inf')
+    stack = [(0, len(pts) - 1, float('inf'))]
+    while stack:
+        anchor, floater, cap = stack.pop()
+        max_dist, farthest = farthest_point(anchor, floater)
+        if max_dist > 0.0:
+            result[farthest] = min(max_dist, cap)
+            stack.append((anchor, farthest, result[farthest]))
+            stack.append((farthest, floater, result[farthest]))
+    return result
+
+def farthest_python (pts):
+    """A function returning the largest distance of the points between
+    anchor and floater from the segment between them, and its index."""
+    def farthest_point (anchor, floater):
         # initialize line segment
         if pts[floater] != pts[anchor]:
             anchorX = float(pts[floater][0] - pts[anchor][0])
@@ -71,17 +142,56 @@ def simplify_points (pts, tolerance):
                 if max_dist < dist_to_seg:
                     max_dist = dist_to_seg
                     farthest = i
+        return max_dist, farthest
+    return farthest_point
 
-        if max_dist <= tolerance: # use line segment
-            keep.add(anchor)
-            keep.add(floater)
+def farthest_numpy (pts):
+    """farthest_python with the distances of all the points of a span
+    computed at once on NumPy arrays.
+
+    NumPy squares with x * x where the loop's x ** 2 goes through libm's
+    pow, so a distance can differ in its last bit. That only matters when
+    two points are exactly as far from a segment, as on integer grids.
+    """
+    xy = numpy.array(pts, dtype=float).reshape(len(pts), 2)
+    xs = xy[:, 0]
+    ys = xy[:, 1]
+
+    def farthest_point (anchor, floater):
+        # initialize line segment
+        if pts[floater] != pts[anchor]:
+            anchorX = xs[floater] - xs[anchor]
+            anchorY = ys[floater] - ys[anchor]
+            seg_len = math.sqrt(anchorX ** 2 + anchorY ** 2)
+            # get the unit vector
+            anchorX /= seg_len
+            anchorY /= seg_len
         else:
-            stack.append((anchor, farthest))
-            stack.append((farthest, floater))
+            anchorX = anchorY = 0.0
 
-    keep = list(keep)
-    keep.sort()
-    return [pts[i] for i in keep]
+        max_dist = 0.0
+        farthest = anchor + 1
+        if floater - anchor > 1:
+            span = slice(anchor + 1, floater)
+            # dot product with the anchor side:
+            proj = ((xs[span] - xs[anchor]) * anchorX +
+                    (ys[span] - ys[anchor]) * anchorY)
+            # compare to floater
+            vecX = xs[span] - xs[floater]
+            vecY = ys[span] - ys[floater]
+            seg_len = numpy.sqrt(vecX ** 2 + vecY ** 2)
+            proj_floater = vecX * (-anchorX) + vecY * (-anchorY)
+            dist_to_seg = numpy.where(
+                proj_floater < 0.0, seg_len,
+                numpy.sqrt(numpy.abs(seg_len ** 2 - proj_floater ** 2)))
+            # like the loop, never pick points behind the anchor
+            dist_to_seg[proj < 0.0] = 0.0
+            i = dist_to_seg.argmax()
+            if dist_to_seg[i] > max_dist:
+                max_dist = float(dist_to_seg[i])
+                farthest = anchor + 1 + i
+        return max_dist, farthest
+    return farthest_point
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""Compact binary files of GeoJSON features.
+
+Coordinates are stored as integers in units of 10 ** -decimals degrees
+(OSM's own 1e-7 by default, which is lossless for OSM data), delta and
+zigzag coded as varints like PBF's dense nodes, so a feature takes a
+fraction of its GeoJSON size and decodes without parsing floats:
+
+    header      'GEOBIN01' and the number of decimals ('<8sI')
+    features    one record after the other:
+                varint length and JSON of the feature without its
+                coordinates, varint count and the lengths of the nested
+                coordinate lists (preorder), varint length and packed
+                x deltas, varint length and packed y deltas
+    index       the offset of every record (native longs)
+    trailer     offset of the index and number of features ('<qq')
+
+Reader finds a feature through the index and decodes only that one.
+Records can also be copied from a Reader to a Writer as they are.
+Coordinates are 2D; a third value is dropped.
+
+>>> from StringIO import StringIO
+>>> feature = {'type': 'Feature', 'properties': {'name': 'A'},
+...            'geometry': {'type': 'Polygon', 'coordinates': [
+...                [[1.5, 2.0], [1.5000001, 2.0], [1.5, -2.25], [1.5, 2.0]]]}}
+>>> out = StringIO()
+>>> writer = Writer(out)
+>>> writer.write(feature)
+>>> writer.write({'type': 'Feature', 'properties': {}, 'geometry': None})
+>>> writer.close()
+>>> reader = Reader(StringIO(out.getvalue()))
+>>> len(reader), reader[0] == feature, reader[1]['geometry']
+(2, True, None)
+"""
+import mmap
+import struct
+from array import array
+from itertools import islice
+import simplejson as json
+from osmread import deltas, packed, varint
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'GEOBIN01'
+HEADER = struct.Struct('<8sI')
+TRAILER = struct.Struct('<qq')
+DECIMALS = 7
+EXTENSIONS = ('.geobin', )
+# how deeply the coordinates of each geometry type are nested
+DEPTHS = {'Point': 0, 'MultiPoint': 1, 'LineString': 1, 'Polygon': 2,
+          'MultiLineString': 2, 'MultiPolygon': 3}
+# Below this many bytes of coordinates decoding them with NumPy costs more
+# than it saves.
+NUMPY_MIN_BYTES = 512
+
+
+def is_geobin(filename):
+    return filename.lower().endswith(EXTENSIONS)
+
+
+def varints(values, out):
+    """Append the varints of the non negative ints `values` to the
+    bytearray `out`."""
+    for value in values:
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return out
+
+
+def zigzag_deltas(values):
+    """The zigzag coded differences of consecutive `values`, which
+    osmread.deltas() undoes."""
+    last = 0
+    for value in values:
+        delta = value - last
+        last = value
+        yield delta << 1 if delta >= 0 else (-delta << 1) - 1
+
+
+def flatten(coordinates, depth, lengths, xs, ys):
+    if depth == 0:
+        xs.append(coordinates[0])
+        ys.append(coordinates[1])
+        return
+    lengths.append(len(coordinates))
+    for part in coordinates:
+        flatten(part, depth - 1, lengths, xs, ys)
+
+
+def nest(depth, lengths, points):
+    """Rebuild what flatten() took apart from iterators over its lengths
+    and [x, y] points."""
+    if depth == 0:
+        return next(points)
+    if depth == 1:
+        return list(islice(points, next(lengths)))
+    return [nest(depth - 1, lengths, points) for i in range(next(lengths))]
+
+
+def encode(feature, decimals=DECIMALS):
+    """The record of `feature`, as a bytearray."""
+    scale = 10 ** decimals
+    geometry = feature.get('geometry')
+    lengths = []
+    xs = []
+    ys = []
+    if geometry is not None:
+        if geometry['type'] not in DEPTHS:
+            raise ValueError("Unsupported geometry type %r"
+                             % geometry['type'])
+        flatten(geometry['coordinates'], DEPTHS[geometry['type']], lengths,
+                xs, ys)
+        meta = dict(feature, geometry=dict(geometry, coordinates=None))
+    else:
+        meta = feature
+    record = bytearray()
+    text = json.dumps(meta, separators=(',', ':'), sort_keys=True)
+    varints([len(text)], record)
+    record.extend(text)
+    varints([len(lengths)] + lengths, record)
+    for values in (xs, ys):
+        coded = varints(zigzag_deltas(int(round(value * scale))
+                                      for value in values), bytearray())
+        varints([len(coded)], record)
+        record.extend(coded)
+    return record
+
+
+def decode(record, decimals=DECIMALS):
+    """The feature of a record (a bytearray)."""
+    scale = float(10 ** decimals)
+    length, pos = varint(record, 0)
+    feature = json.loads(str(record[pos:pos + length]))
+    pos += length
+    count, pos = varint(record, pos)
+    lengths = []
+    for i in range(count):
+        length, pos = varint(record, pos)
+        lengths.append(length)
+    spans = []
+    for i in range(2):
+        length, pos = varint(record, pos)
+        spans.append((pos, pos + length))
+        pos += length
+    if numpy is not None and pos - spans[0][0] >= NUMPY_MIN_BYTES:
+        points = (numpy.column_stack([deltas_numpy(record, start, end)
+                                      for start, end in spans])
+                  / scale).tolist()
+    else:
+        xs, ys = [deltas(packed(record, span)) for span in spans]
+        points = [[x / scale, y / scale] for x, y in zip(xs, ys)]
+    geometry = feature.get('geometry')
+    if geometry is not None:
+        geometry['coordinates'] = nest(DEPTHS[geometry['type']],
+                                       iter(lengths), iter(points))
+    return feature
+
+
+def deltas_numpy(record, start, end):
+    """osmread.deltas(osmread.packed(record, (start, end))) as a NumPy
+    array, decoded without a loop over the bytes."""
+    length = end - start
+    data = numpy.frombuffer(record, numpy.uint8, length, start)
+    if not length:
+        return numpy.zeros(0, numpy.int64)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # every byte's 7 bits go that far into its varint's value
+    shifts = 7 * (numpy.arange(length) -
+                  numpy.repeat(starts, ends - starts + 1))
+    values = numpy.add.reduceat(
+        (data & 0x7f).astype(numpy.int64) << shifts, starts)
+    return numpy.cumsum((values >> 1) ^ -(values & 1))
+
+
+class Writer(object):
+    """Write features to `fileobj` as they come, coordinates rounded to
+    `decimals`. close() writes the index."""
+    def __init__(self, fileobj, decimals=DECIMALS):
+        self.fileobj = fileobj
+        self.decimals = decimals
+        self.offsets = array('l')
+        self.offset = HEADER.size
+        fileobj.write(HEADER.pack(MAGIC, decimals))
+
+    def write(self, feature):
+        self.write_record(encode(feature, self.decimals))
+
+    def write_record(self, record):
+        """Write a record as encode() or Reader.record() returns it, with
+        this writer's decimals."""
+        self.offsets.append(self.offset)
+        self.fileobj.write(record)
+        self.offset += len(record)
+
+    @property
+    def count(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.fileobj.write(self.offsets.tostring())
+        self.fileobj.write(TRAILER.pack(self.offset, len(self.offsets)))
+
+
+class Reader(object):
+    """Random access to the features of the file object `fileobj`, which
+    is memory-mapped when it has a file descriptor."""
+    def __init__(self, fileobj):
+        if hasattr(fileobj, 'fileno'):
+            self.data = mmap.mmap(fileobj.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = fileobj.read()
+        magic, self.decimals = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a geobin file")
+        index, count = TRAILER.unpack_from(self.data,
+                                           len(self.data) - TRAILER.size)
+        self.offsets = array('l')
+        self.offsets.fromstring(
+            self.data[index:index + count * self.offsets.itemsize])
+        self.offsets.append(index)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def record(self, i):
+        """The undecoded record of the `i`th feature."""
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return bytearray(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return decode(self.record(i), self.decimals)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write(filename, features, decimals=DECIMALS):
+    """Write the iterable `features` to `filename`. Returns the number of
+    features."""
+    with open(filename, 'wb') as fileobj:
+        writer = Writer(fileobj, decimals)
+        for feature in features:
+            writer.write(feature)
+        writer.close()
+    return writer.count
+
+
+def read(filename):
+    """Yield the features of `filename`."""
+    with open(filename, 'rb') as fileobj:
+        for feature in Reader(fileobj):
+            yield feature
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Read and write GeoJSON one feature at a time.
+
+Writer streams features to a FeatureCollection, or to newline delimited
+GeoJSON (one feature per line), compactly and optionally with coordinates
+rounded to a number of decimals. read() decodes the features of either
+one by one, holding at most a feature and a read block in memory.
+
+Files are newline delimited when their extension is one of
+NDJSON_EXTENSIONS, and in the binary format of geobin.py when it is one
+of geobin.EXTENSIONS.
+
+>>> from StringIO import StringIO
+>>> out = StringIO()
+>>> writer = Writer(out, precision=2)
+>>> writer.write({'type': 'Feature', 'properties': {'name': 'A'},
+...               'geometry': {'type': 'Point',
+...                            'coordinates': [1.23456, 2.5]}})
+>>> writer.close()
+>>> print(out.getvalue().strip())
+{"type":"FeatureCollection","features":[
+{"geometry":{"coordinates":[1.23,2.5],"type":"Point"},"properties":{"name":"A"},"type":"Feature"}
+]}
+>>> [feature['geometry']['coordinates'] for feature in read_collection(
+...     StringIO(out.getvalue()), 8)]
+[[1.23, 2.5]]
+"""
+import os
+import simplejson as json
+import geobin
+
+NDJSON_EXTENSIONS = ('.ndjson', '.geojsonl', '.geojsons')
+BLOCK = 64 * 1024
+SEPARATORS = (',', ':')
+
+
+def is_ndjson(filename):
+    return os.path.splitext(filename)[1].lower() in NDJSON_EXTENSIONS
+
+
+def round_coordinates(coordinates, precision):
+    """Nested coordinate lists with every number rounded to `precision`
+    decimals."""
+    if coordinates and isinstance(coordinates[0], (int, long, float)):
+        return [round(value, precision) for value in coordinates]
+    return [round_coordinates(part, precision) for part in coordinates]
+
+
+class Writer(object):
+    """Write features to `fileobj` as they come, as a FeatureCollection
+    or, with `ndjson`, one per line. close() ends the collection."""
+    def __init__(self, fileobj, precision=None, ndjson=False):
+        self.fileobj = fileobj
+        self.precision = precision
+        self.ndjson = ndjson
+        self.count = 0
+
+    def write(self, feature):
+        if self.precision is not None and feature.get('geometry'):
+            geometry = dict(feature['geometry'])
+            geometry['coordinates'] = round_coordinates(
+                geometry['coordinates'], self.precision)
+            feature = dict(feature, geometry=geometry)
+        text = json.dumps(feature, separators=SEPARATORS, sort_keys=True)
+        if self.ndjson:
+            self.fileobj.write(text + '\n')
+        elif self.count:
+            self.fileobj.write(',\n' + text)
+        else:
+            self.fileobj.write('{"type":"FeatureCollection","features":[\n'
+                               + text)
+        self.count += 1
+
+    def close(self):
+        if self.ndjson:
+            return
+        if not self.count:
+            self.fileobj.write('{"type":"FeatureCollection","features":[')
+        self.fileobj.write('\n]}\n')
+
+
+def open_writer(fileobj, filename, precision=None):
+    """A Writer, or a geobin.Writer, for `fileobj` in the format the
+    extension of `filename` asks for."""
+    if geobin.is_geobin(filename):
+        if precision is None:
+            precision = geobin.DECIMALS
+        return geobin.Writer(fileobj, precision)
+    return Writer(fileobj, precision, is_ndjson(filename))
+
+
+def write(filename, features, precision=None):
+    """Write the iterable `features` to `filename`, in the format its
+    extension asks for. Returns the number of features."""
+    with open(filename, 'wb') as fileobj:
+        writer = open_writer(fileobj, filename, precision)
+        for feature in features:
+            writer.write(feature)
+        writer.close()
+    return writer.count
+
+
+def read(filename):
+    """Yield the features of the FeatureCollection or newline delimited
+    GeoJSON, or geobin file, in `filename`."""
+    with open(filename, 'rb') as fileobj:
+        if geobin.is_geobin(filename):
+            for feature in geobin.Reader(fileobj):
+                yield feature
+        elif is_ndjson(filename):
+            for line in fileobj:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for feature in read_collection(fileobj):
+                yield feature
+
+
+class StreamDecoder(object):
+    """Decode consecutive JSON values from a file, reading it `block`
+    bytes at a time."""
+    def __init__(self, fileobj, block=BLOCK):
+        self.fileobj = fileobj
+        self.block = block
+        self.data = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size):
+        if self.pos > len(self.data) // 2:
+            self.data = self.data[self.pos:]
+            self.pos = 0
+        more = self.fileobj.read(size)
+        self.eof = not more
+        self.data += more
+
+    def skip_space(self):
+        while True:
+            while self.pos < len(self.data) and self.data[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.data) or self.eof:
+                return
+            self.fill(self.block)
+
+    def char(self, expected):
+        """Consume the next non space character, one of `expected`."""
+        self.skip_space()
+        char = self.data[self.pos:self.pos + 1]
+        if not char or char not in expected:
+            raise ValueError("Expected one of %r at %r" % (
+                expected, self.data[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def peek(self):
+        self.skip_space()
+        return self.data[self.pos:self.pos + 1]
+
+    def value(self):
+        """Decode the next value, reading as much as it takes."""
+        self.skip_space()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.data, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the data may not be complete
+                if end < len(self.data) or self.eof:
+                    # read ahead as much as the largest value, which the
+                    # next one is likely to be like
+                    self.block = max(self.block, end - self.pos)
+                    self.pos = end
+                    return value
+            # read as much again as is pending, so large values are not
+            # decoded over and over
+            self.fill(max(self.block, len(self.data) - self.pos))
+
+
+def read_collection(fileobj, block=BLOCK):
+    """Yield the features of the FeatureCollection in `fileobj`, skipping
+    its other members."""
+    stream = StreamDecoder(fileobj, block)
+    stream.char('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.char(':')
+        if key == 'features':
+            stream.char('[')
+            if stream.peek() == ']':
+                stream.char(']')
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.char(',]') == ']':
+                        break
+        else:
+            stream.value()
+        if stream.char(',}') == '}':
+            return
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
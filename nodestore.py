@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""Compact node coordinate stores.
+
+The stores map node ids to (lon, lat) tuples like the dicts parser.py and
+parser2.py used to build, but keep the coordinates as 32 bit fixed point
+integers in OSM's own precision of 1e-7 degrees. Coordinates with at most
+seven decimals, which is all OSM data, come back as exactly the same
+floats.
+
+    SortedNodeStore  ids, lons and lats in parallel arrays, looked up by
+                     bisecting the ids. 16 bytes per node.
+    DenseNodeStore   coordinates indexed directly by node id. 8 bytes per
+                     id up to the largest one, for near-planet inputs.
+    MappedNodeStore  a DenseNodeStore kept in a sparse file through mmap,
+                     so a planet's coordinates page in lazily.
+    ChainedNodeStore a read-only union of SortedNodeStores, e.g. the ones
+                     decoded from consecutive chunks of a file.
+
+>>> store = SortedNodeStore()
+>>> store[3] = (12.3456789, -45.6)
+>>> store[1] = (0.0, 0.0)
+>>> store[3], 1 in store, 2 in store, len(store)
+((12.3456789, -45.6), True, False, 2)
+>>> store = DenseNodeStore()
+>>> store[5] = (-180.0, 90.0)
+>>> store[5], store.get(4)
+((-180.0, 90.0), None)
+"""
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from itertools import chain
+import sharedarray
+
+SCALE = 10000000
+# Dense stores keep coordinates shifted into unsigned ints so that zero,
+# what new array slots and file pages hold, can mean "no such node".
+OFFSET = 2 ** 31
+KINDS = ('dict', 'sorted', 'dense', 'mmap')
+
+
+def encode(value):
+    return int(round(value * SCALE))
+
+
+def decode(value):
+    return value / float(SCALE)
+
+
+class SortedNodeStore(object):
+    """Append-only store bisecting a sorted array of ids.
+
+    Ids are expected to arrive in ascending order, as they do in OSM
+    files. Otherwise the arrays are sorted on the first lookup.
+
+    arrays() and from_arrays() expose the three arrays, so a store can be
+    dumped by one process and attached by another with sharedarray.
+    Attached stores are read-only.
+    """
+    TYPECODES = ('l', 'i', 'i')
+
+    def __init__(self):
+        self.ids = array('l')
+        self.lons = array('i')
+        self.lats = array('i')
+        self.sorted = True
+
+    @classmethod
+    def from_arrays(cls, ids, lons, lats, sorted=True):
+        store = cls()
+        store.ids, store.lons, store.lats = ids, lons, lats
+        store.sorted = sorted
+        return store
+
+    def arrays(self):
+        return self.ids, self.lons, self.lats
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name, typecode in zip(('ids', 'lons', 'lats'), self.TYPECODES):
+            state[name] = sharedarray.to_array(typecode, state[name])
+        return state
+
+    def add(self, node_id, lon, lat):
+        if self.ids and node_id < self.ids[-1]:
+            self.sorted = False
+        self.ids.append(node_id)
+        self.lons.append(encode(lon))
+        self.lats.append(encode(lat))
+
+    def __setitem__(self, node_id, coords):
+        self.add(node_id, coords[0], coords[1])
+
+    def update(self, other):
+        """Add the nodes of another store, or of (id, coords) pairs."""
+        if isinstance(other, ChainedNodeStore):
+            for store in other.stores:
+                self.update(store)
+        elif isinstance(other, SortedNodeStore):
+            if len(other) and len(self) and other.ids[0] < self.ids[-1]:
+                self.sorted = False
+            self.sorted = self.sorted and other.sorted
+            ids, lons, lats = other.arrays()
+            self.ids.extend(sharedarray.to_array('l', ids))
+            self.lons.extend(sharedarray.to_array('i', lons))
+            self.lats.extend(sharedarray.to_array('i', lats))
+        else:
+            for node_id, coords in items(other):
+                self[node_id] = coords
+
+    def items(self):
+        for i, node_id in enumerate(self.ids):
+            yield node_id, (decode(self.lons[i]), decode(self.lats[i]))
+
+    def sort(self):
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('l', (self.ids[i] for i in order))
+        self.lons = array('i', (self.lons[i] for i in order))
+        self.lats = array('i', (self.lats[i] for i in order))
+        self.sorted = True
+
+    def index(self, node_id):
+        if not self.sorted:
+            self.sort()
+        # rightmost match, so a re-added id wins like it would in a dict
+        i = bisect_right(self.ids, node_id) - 1
+        if i >= 0 and self.ids[i] == node_id:
+            return i
+        return -1
+
+    def get(self, node_id, default=None):
+        i = self.index(node_id)
+        if i < 0:
+            return default
+        return decode(self.lons[i]), decode(self.lats[i])
+
+    def __getitem__(self, node_id):
+        coords = self.get(node_id)
+        if coords is None:
+            raise KeyError(node_id)
+        return coords
+
+    def __contains__(self, node_id):
+        return self.index(node_id) >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ChainedNodeStore(object):
+    """Read-only union of SortedNodeStores, later stores winning.
+
+    When each store only holds ids above those of the store before it, as
+    with the chunks of a sorted file, lookups bisect the stores' first ids
+    and then search only one of them.
+    """
+    def __init__(self, stores):
+        self.stores = [store for store in stores if len(store)]
+        for store in self.stores:
+            if not store.sorted:
+                store.sort()
+        self.firsts = [store.ids[0] for store in self.stores]
+        self.ordered = all(before.ids[-1] < after.ids[0] for before, after
+                           in zip(self.stores, self.stores[1:]))
+
+    def get(self, node_id, default=None):
+        if self.ordered:
+            i = bisect_right(self.firsts, node_id) - 1
+            if i < 0:
+                return default
+            return self.stores[i].get(node_id, default)
+        for store in reversed(self.stores):
+            coords = store.get(node_id)
+            if coords is not None:
+                return coords
+        return default
+
+    def __getitem__(self, node_id):
+        coords = self.get(node_id)
+        if coords is None:
+            raise KeyError(node_id)
+        return coords
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def items(self):
+        return chain(*[store.items() for store in self.stores])
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+
+class DenseNodeStore(object):
+    """Store indexed directly by node id, for ids that are not sparse."""
+    # entries added at most at once: growing doubles small stores, but a
+    # near-planet one grows by this much, and never through a temporary
+    # array larger than it
+    STEP = 8 * 1024 * 1024
+
+    def __init__(self):
+        self.coords = array('I')
+        self.count = 0
+
+    def grow(self, size):
+        size = max(size, min(2 * len(self.coords),
+                             len(self.coords) + self.STEP))
+        zeros = array('I', [0]) * min(size - len(self.coords), self.STEP)
+        while len(self.coords) + len(zeros) <= size:
+            self.coords.extend(zeros)
+        if len(self.coords) < size:
+            self.coords.extend(zeros[:size - len(self.coords)])
+
+    def add(self, node_id, lon, lat):
+        if node_id < 0:
+            raise ValueError("Dense node stores need positive ids, got %d"
+                             % node_id)
+        i = 2 * node_id
+        if i >= len(self.coords):
+            self.grow(i + 2)
+        if not self.coords[i]:
+            self.count += 1
+        self.coords[i] = encode(lon) + OFFSET
+        self.coords[i + 1] = encode(lat) + OFFSET
+
+    def __setitem__(self, node_id, coords):
+        self.add(node_id, coords[0], coords[1])
+
+    def update(self, other):
+        """Add the nodes of another store, or of (id, coords) pairs."""
+        for node_id, coords in items(other):
+            self[node_id] = coords
+
+    def items(self):
+        for node_id in xrange(len(self.coords) // 2):
+            coords = self.get(node_id)
+            if coords is not None:
+                yield node_id, coords
+
+    def get(self, node_id, default=None):
+        i = 2 * node_id
+        if node_id < 0 or i >= len(self.coords) or not self.coords[i]:
+            return default
+        return (decode(self.coords[i] - OFFSET),
+                decode(self.coords[i + 1] - OFFSET))
+
+    def __getitem__(self, node_id):
+        coords = self.get(node_id)
+        if coords is None:
+            raise KeyError(node_id)
+        return coords
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def __len__(self):
+        return self.count
+
+
+class MappedNodeStore(DenseNodeStore):
+    """DenseNodeStore kept in `filename` and memory-mapped.
+
+    The file grows sparsely, so ids that never appear cost no disk and
+    lookups only page in the parts of the file they touch. Pickling the
+    store pickles its filename, so it can be handed to other processes.
+    An existing file is emptied unless `truncate` is false.
+    """
+    RECORD = struct.Struct('<II')
+    GROWTH = 64 * 1024 * 1024
+
+    def __init__(self, filename, truncate=True):
+        self.filename = filename
+        if truncate or not os.path.exists(filename):
+            self.fileobj = open(filename, 'w+b')
+        else:
+            self.fileobj = open(filename, 'r+b')
+        self.count = 0
+        self.size = 0
+        self.mapping = None
+        self.remap()
+
+    def remap(self):
+        if self.mapping is not None:
+            self.mapping.close()
+        self.size = os.fstat(self.fileobj.fileno()).st_size
+        if self.size:
+            self.mapping = mmap.mmap(self.fileobj.fileno(), self.size)
+        else:
+            self.mapping = None
+
+    def grow(self, size):
+        size = max(size, self.size + self.GROWTH)
+        self.fileobj.truncate(size)
+        self.remap()
+
+    def add(self, node_id, lon, lat):
+        if node_id < 0:
+            raise ValueError("Dense node stores need positive ids, got %d"
+                             % node_id)
+        offset = node_id * self.RECORD.size
+        if offset >= self.size:
+            self.grow(offset + self.RECORD.size)
+        if not self.RECORD.unpack_from(self.mapping, offset)[0]:
+            self.count += 1
+        self.RECORD.pack_into(self.mapping, offset, encode(lon) + OFFSET,
+                              encode(lat) + OFFSET)
+
+    def get(self, node_id, default=None):
+        offset = node_id * self.RECORD.size
+        if node_id < 0 or offset >= self.size:
+            return default
+        lon, lat = self.RECORD.unpack_from(self.mapping, offset)
+        if not lon:
+            return default
+        return decode(lon - OFFSET), decode(lat - OFFSET)
+
+    def items(self):
+        for node_id in xrange(self.size // self.RECORD.size):
+            coords = self.get(node_id)
+            if coords is not None:
+                yield node_id, coords
+
+    def flush(self):
+        if self.mapping is not None:
+            self.mapping.flush()
+
+    def __getstate__(self):
+        self.flush()
+        return {'filename': self.filename, 'count': self.count}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], truncate=False)
+        self.count = state['count']
+
+
+def items(store):
+    """(id, coords) pairs of a store, a dict or an iterable of pairs."""
+    if isinstance(store, dict):
+        return store.iteritems()
+    if hasattr(store, 'items'):
+        return store.items()
+    return store
+
+
+def merge(store, other):
+    """Add the nodes of `other` to `store`, either of which may be a dict."""
+    if isinstance(store, dict):
+        store.update(items(other))
+    else:
+        store.update(other)
+
+
+def create(kind='sorted', filename=None):
+    """Return an empty store of the given kind, one of KINDS."""
+    if kind == 'dict':
+        return {}
+    if kind == 'sorted':
+        return SortedNodeStore()
+    if kind == 'dense':
+        return DenseNodeStore()
+    if kind == 'mmap':
+        if not filename:
+            raise ValueError("mmap node store needs a filename")
+        return MappedNodeStore(filename)
+    raise ValueError("Unknown node store %r" % kind)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
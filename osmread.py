@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""Read nodes, ways and relations from .osm (XML) and .pbf files.
+
+Both formats come out as the same compact primitives:
+
+    ('node', id, (lon, lat))
+    ('way', id, [node ref, ...])
+    ('relation', id, ({key: value}, [(member type, ref, role), ...]))
+
+The PBF decoder is self-contained: it walks the protobuf wire format of
+the blobs and primitive blocks described at
+http://wiki.openstreetmap.org/wiki/PBF_Format, including dense nodes.
+
+read_changes() reads OSM change files (.osc) the same way, as (action,
+kind, id, value) with the action 'create', 'modify' or 'delete' and a
+value of None for deletions.
+
+chunks() splits a file into byte ranges that read_chunk() decodes on
+their own, at blob boundaries for PBF and at top level elements for XML,
+so several processes can share the work.
+
+Files ending in .gz, .bz2 or .xz are decompressed on the fly (see
+compression.py), after which their extension tells their format. They
+cannot be split, and make a single chunk.
+"""
+import os
+import re
+import struct
+import zlib
+from lxml import etree
+import compression
+
+KINDS = ('node', 'way', 'relation')
+MEMBER_TYPES = ('node', 'way', 'relation')
+# Features of the PBF header block this reader understands
+PBF_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])
+
+
+def read(filename, kinds=KINDS):
+    """Yield the primitives of the given kinds from `filename`."""
+    kinds = frozenset(kinds)
+    with compression.open_input(filename) as sourcefile:
+        if compression.base_name(filename).endswith('.pbf'):
+            reader = read_pbf
+        else:
+            reader = read_xml
+        for primitive in reader(sourcefile, kinds):
+            yield primitive
+
+
+def chunks(filename, count):
+    """Split `filename` into at most `count` (start, end) byte ranges of
+    about the same size, each of which read_chunk() can decode."""
+    if compression.is_compressed(filename):
+        return [(0, None)]
+    with open(filename, 'rb') as sourcefile:
+        if filename.endswith('.pbf'):
+            bounds = pbf_bounds(sourcefile)
+        else:
+            # sample a few candidate boundaries per chunk
+            size = os.fstat(sourcefile.fileno()).st_size
+            block = min(max(size // (8 * count), 4096), 1024 * 1024)
+            bounds = xml_bounds(sourcefile, block)
+    if len(bounds) < 2:
+        return []
+    first, last = bounds[0], bounds[-1]
+    start = first
+    ranges = []
+    for i in range(1, count + 1):
+        target = first + (last - first) * i // count
+        # first boundary at or after the target
+        boundary = next(bound for bound in bounds if bound >= target)
+        if boundary > start:
+            ranges.append((start, boundary))
+            start = boundary
+    return ranges
+
+
+def read_chunk(filename, chunk, kinds=KINDS):
+    """Yield the primitives of the given kinds in the chunk (start, end)
+    of `filename`, as returned by chunks(). The chunk (0, None) is the
+    whole file."""
+    kinds = frozenset(kinds)
+    start, end = chunk
+    if end is None:
+        for primitive in read(filename, kinds):
+            yield primitive
+        return
+    with open(filename, 'rb') as sourcefile:
+        sourcefile.seek(start)
+        if filename.endswith('.pbf'):
+            primitives = read_pbf(RangeFile(sourcefile, end - start), kinds)
+        else:
+            primitives = read_xml(RangeFile(sourcefile, end - start,
+                                            '<osm>', '</osm>'), kinds)
+        for primitive in primitives:
+            yield primitive
+
+
+class RangeFile(object):
+    """File-like view of the next `size` bytes of `fileobj`, optionally
+    wrapped in a prefix and suffix."""
+    def __init__(self, fileobj, size, prefix='', suffix=''):
+        self.fileobj = fileobj
+        self.left = size
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.left + len(self.prefix) + len(self.suffix)
+        data = self.prefix[:size]
+        self.prefix = self.prefix[len(data):]
+        if len(data) < size and self.left:
+            body = self.fileobj.read(min(size - len(data), self.left))
+            self.left -= len(body)
+            if not body:
+                self.left = 0
+            data += body
+        if len(data) < size and not self.left:
+            tail = self.suffix[:size - len(data)]
+            self.suffix = self.suffix[len(tail):]
+            data += tail
+        return data
+
+##########
+#        #
+#  XML   #
+#        #
+##########
+
+def xml_value(elem):
+    """The value of the primitive of a node, way or relation element."""
+    if elem.tag == 'node':
+        return float(elem.get('lon')), float(elem.get('lat'))
+    if elem.tag == 'way':
+        return [int(child.get('ref')) for child in elem.iterchildren('nd')]
+    tags = {}
+    members = []
+    for child in elem.iterchildren():
+        if child.tag == 'tag':
+            tags[child.get('k')] = child.get('v')
+        elif child.tag == 'member':
+            members.append((child.get('type'), int(child.get('ref')),
+                            child.get('role')))
+    return tags, members
+
+
+def drop(elem):
+    """Drop the element and everything parsed before it."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def read_xml(fileobj, kinds=KINDS):
+    for action, elem in etree.iterparse(fileobj, tag=KINDS):
+        if elem.tag in kinds:
+            yield elem.tag, int(elem.get('id')), xml_value(elem)
+        drop(elem)
+
+
+def read_changes(filename, kinds=KINDS):
+    """Yield the (action, kind, id, value) changes of the given kinds in
+    the OSM change file `filename`, in file order."""
+    kinds = frozenset(kinds)
+    with compression.open_input(filename) as sourcefile:
+        for action, elem in etree.iterparse(sourcefile, tag=KINDS):
+            if elem.tag in kinds:
+                action = elem.getparent().tag
+                value = None if action == 'delete' else xml_value(elem)
+                yield action, elem.tag, int(elem.get('id')), value
+            drop(elem)
+
+
+ELEMENT_START = re.compile(r'<(?:node|way|relation)[\s/>]')
+
+
+def xml_bounds(fileobj, block=1024 * 1024):
+    """Offsets where top level elements may start: the first node, way or
+    relation, one element start per `block` bytes, and the closing
+    </osm>. Markup cannot contain a raw '<', so any element start tag
+    found is a top level one."""
+    size = os.fstat(fileobj.fileno()).st_size
+    tail = max(size - block, 0)
+    fileobj.seek(tail)
+    end = tail + fileobj.read().rfind('</osm>')
+    if end < tail:
+        raise ValueError("No closing </osm> in %r" % fileobj.name)
+    bounds = []
+    pos = 0
+    while pos < end:
+        fileobj.seek(pos)
+        match = ELEMENT_START.search(fileobj.read(block))
+        if match is None:
+            # element starts are never a whole block apart in OSM files
+            pos += block - 16
+            continue
+        if match.start() + pos >= end:
+            break
+        bounds.append(match.start() + pos)
+        pos = max(pos + block, bounds[-1] + 1)
+    bounds.append(end)
+    return bounds
+
+##########
+#        #
+#  PBF   #
+#        #
+##########
+
+def varint(buf, pos):
+    """Decode the varint at buf[pos], return it and the next position."""
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def signed(value):
+    """Two's complement int64 from its unsigned varint."""
+    if value >= 1 << 63:
+        return value - (1 << 64)
+    return value
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def fields(buf, pos=0, end=None):
+    """Yield (field number, value) of the protobuf message buf[pos:end].
+
+    Varints are returned as ints, length delimited fields as their
+    (start, end) positions in buf so nothing is copied.
+    """
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        key, pos = varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 1:
+            value = struct.unpack_from('<Q', buffer(buf), pos)[0]
+            pos += 8
+        elif wire_type == 5:
+            value = struct.unpack_from('<I', buffer(buf), pos)[0]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+def packed(buf, span):
+    """The varints of a packed repeated field at buf[span[0]:span[1]]."""
+    pos, end = span
+    values = []
+    append = values.append
+    while pos < end:
+        result = shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def deltas(values):
+    """Undo the zigzag delta coding of packed sint64 fields in place."""
+    last = 0
+    for i, value in enumerate(values):
+        last += (value >> 1) ^ -(value & 1)
+        values[i] = last
+    return values
+
+
+def pbf_bounds(fileobj):
+    """Offsets of every blob (header included) and of the end of file."""
+    bounds = []
+    while True:
+        bounds.append(fileobj.tell())
+        size = fileobj.read(4)
+        if len(size) < 4:
+            return bounds
+        header = bytearray(fileobj.read(struct.unpack('>I', size)[0]))
+        for number, value in fields(header):
+            if number == 3:
+                fileobj.seek(value, os.SEEK_CUR)
+
+
+def read_blobs(fileobj):
+    """Yield (type, data) of every blob, with data decompressed."""
+    while True:
+        size = fileobj.read(4)
+        if len(size) < 4:
+            return
+        header = bytearray(fileobj.read(struct.unpack('>I', size)[0]))
+        blob_type = None
+        datasize = 0
+        for number, value in fields(header):
+            if number == 1:
+                blob_type = str(header[value[0]:value[1]])
+            elif number == 3:
+                datasize = value
+        yield blob_type, blob_data(bytearray(fileobj.read(datasize)))
+
+
+def blob_data(blob):
+    """The uncompressed data of a blob. Raises ValueError for data in any
+    other compression than zlib (lzma, bzip2, lz4, zstd), or none."""
+    for number, value in fields(blob):
+        if number == 1:
+            return blob[value[0]:value[1]]
+        elif number == 3:
+            return bytearray(zlib.decompress(buffer(blob, value[0],
+                                                    value[1] - value[0])))
+        elif number != 2:
+            break
+    raise ValueError("Only raw and zlib compressed PBF blobs are supported")
+
+
+def check_header(block):
+    for number, value in fields(block):
+        if number == 4:
+            feature = str(block[value[0]:value[1]])
+            if feature not in PBF_FEATURES:
+                raise ValueError("Unsupported PBF feature %r" % feature)
+
+
+def read_pbf(fileobj, kinds=KINDS):
+    for blob_type, data in read_blobs(fileobj):
+        if blob_type == 'OSMHeader':
+            check_header(data)
+        elif blob_type == 'OSMData':
+            for primitive in read_block(data, kinds):
+                yield primitive
+
+
+def read_block(block, kinds=KINDS):
+    """Yield the primitives of a PrimitiveBlock."""
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = lon_offset = 0
+    for number, value in fields(block):
+        if number == 1:
+            strings = [block[start:end].decode('utf-8') for n, (start, end)
+                       in fields(block, *value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 19:
+            lat_offset = signed(value)
+        elif number == 20:
+            lon_offset = signed(value)
+
+    def coords(lon, lat):
+        # same floats as parsing the 7 decimals of the XML
+        return ((lon_offset + granularity * lon) / 1e9,
+                (lat_offset + granularity * lat) / 1e9)
+
+    for start, end in groups:
+        for number, value in fields(block, start, end):
+            if number == 1 and 'node' in kinds:
+                yield read_node(block, value, coords)
+            elif number == 2 and 'node' in kinds:
+                for primitive in read_dense(block, value, coords):
+                    yield primitive
+            elif number == 3 and 'way' in kinds:
+                yield read_way(block, value)
+            elif number == 4 and 'relation' in kinds:
+                yield read_relation(block, value, strings)
+
+
+def read_node(block, span, coords):
+    node_id = lat = lon = 0
+    for number, value in fields(block, *span):
+        if number == 1:
+            node_id = zigzag(value)
+        elif number == 8:
+            lat = zigzag(value)
+        elif number == 9:
+            lon = zigzag(value)
+    return 'node', node_id, coords(lon, lat)
+
+
+def read_dense(block, span, coords):
+    ids = lats = lons = ()
+    for number, value in fields(block, *span):
+        if number == 1:
+            ids = deltas(packed(block, value))
+        elif number == 8:
+            lats = deltas(packed(block, value))
+        elif number == 9:
+            lons = deltas(packed(block, value))
+    for node_id, lon, lat in zip(ids, lons, lats):
+        yield 'node', node_id, coords(lon, lat)
+
+
+def read_way(block, span):
+    way_id = 0
+    refs = []
+    for number, value in fields(block, *span):
+        if number == 1:
+            way_id = signed(value)
+        elif number == 8:
+            refs = deltas(packed(block, value))
+    return 'way', way_id, refs
+
+
+def read_relation(block, span, strings):
+    relation_id = 0
+    keys = vals = roles = refs = types = ()
+    for number, value in fields(block, *span):
+        if number == 1:
+            relation_id = signed(value)
+        elif number == 2:
+            keys = packed(block, value)
+        elif number == 3:
+            vals = packed(block, value)
+        elif number == 8:
+            roles = packed(block, value)
+        elif number == 9:
+            refs = deltas(packed(block, value))
+        elif number == 10:
+            types = packed(block, value)
+    tags = dict((strings[key], strings[val]) for key, val in zip(keys, vals))
+    members = [(MEMBER_TYPES[member_type], ref, strings[role])
+               for member_type, ref, role in zip(types, refs, roles)]
+    return 'relation', relation_id, (tags, members)
@@ -1,12 +1,25 @@
 #!/usr/bin/env python
-import simplejson as json
-from lxml import etree
 from copy import deepcopy
+from array import array
+import geojsonio
+import nodestore
+import osmread
+import tagexpr
 
 border_ways = {}
+# node id -> (lon, lat), a nodestore store once generate() runs
 border_nodes = {}
+# Ways seen during the single pass, kept as flat arrays:
+# way_refs[way_offsets[i]:way_offsets[i + 1]] are the node refs of
+# way_ids[i].
+way_ids = array('l')
+way_offsets = array('l', [0])
+way_refs = array('l')
 relations_ways = {}
 relations = {}
+# way id -> relation ids, relation id -> features (see generate_indexes)
+way_relations = {}
+relation_features = {}
 country_data_default = {
     'type': "Feature",
     'geometry': {
@@ -20,69 +33,163 @@ country_data_default = {
     }
 }
 countries_data = []
+country_data = None
+# tags -> whether to keep the relation, None to keep all (see generate)
+keep_relation = None
 
-def generate_nodes(filename):
-    for action, elem in etree.iterparse(open(filename, 'rb'), tag="node"):
-        border_nodes[elem.get('id')] = (float(elem.get('lon')),
-                                        float(elem.get('lat')))
-def generate_relations(filename):
-    for action, elem in etree.iterparse(open(filename, 'rb'), tag="relation"):
-        ways = []
-        relation_id = elem.get('id')
-        country_name = ''
-        for child in elem.getchildren():
-            if child.tag == 'tag' and child.get('k') == 'NAME':
-                country_name = child.get('v')
-            if child.tag == 'member' and child.get('type') == 'way':
-                ways.append(child.get('ref'))
-        if country_name == '':
-            country_name = relation_id
-
-        if country_name not in relations:
-            relations[country_name] = []
-            country_data = deepcopy(country_data_default)
-            country_data['properties']['name'] = country_name
-            country_data['properties']['id'] = relation_id
-
-        if relation_id not in relations_ways:
-            relations_ways[relation_id] = []
-
-        countries_data.append(country_data)
-        relations_ways[relation_id].extend(ways)
-
-def generate_ways(filename):
-    for action, elem in etree.iterparse(open(filename, 'rb'), tag="way"):
-        way_id = elem.get('id')
+def add_relation(relation_id, relation):
+    tags, members = relation
+    if keep_relation is not None and not keep_relation(tags):
+        return
+    relation_id = str(relation_id)
+    ways = [ref for member_type, ref, role in members if member_type == 'way']
+    country_name = tags.get('NAME', '')
+    if country_name == '':
+        country_name = relation_id
+
+    global country_data
+    if country_name not in relations:
+        relations[country_name] = []
+        country_data = deepcopy(country_data_default)
+        country_data['properties']['name'] = country_name
+        country_data['properties']['id'] = relation_id
+
+    if relation_id not in relations_ways:
+        relations_ways[relation_id] = []
+
+    countries_data.append(country_data)
+    relations_ways[relation_id].extend(ways)
+
+def add_way(way_id, refs):
+    way_ids.append(way_id)
+    way_refs.extend(refs)
+    way_offsets.append(len(way_refs))
+
+def add_node(node_id, coords):
+    border_nodes[node_id] = coords
+
+def add_border_node(node_id, coords, needed):
+    if node_id in needed:
+        border_nodes[node_id] = coords
+
+def parse(filename, handlers):
+    """Run handlers[kind](id, value) for the osmread primitives of the
+    source file, reading only the kinds there are handlers for."""
+    for kind, osm_id, value in osmread.read(filename, handlers):
+        handlers[kind](osm_id, value)
+
+def generate(filename, needed_only=False, node_store='sorted',
+             node_file=None, relation_expression=None):
+    """Read the source file once, keeping nodes and ways in compact form
+    until the relations (which come last) tell us what is needed.
+
+    With `needed_only` the file is read twice instead: ways and relations
+    first, then only the coordinates of boundary nodes are kept, so memory
+    scales with the boundaries rather than with the whole file.
+
+    Coordinates go to a nodestore store of kind `node_store`, backed by
+    `node_file` for the mmap kind.
+
+    Only the relations whose tags match `relation_expression` (see
+    tagexpr.py) are kept, and so only their ways and nodes are used.
+    """
+    global border_nodes, keep_relation
+    border_nodes = nodestore.create(node_store, node_file)
+    keep_relation = None
+    if relation_expression:
+        keep_relation = tagexpr.compile_expression(relation_expression)
+    if needed_only:
+        parse(filename, {'way': add_way, 'relation': add_relation})
+        needed = needed_node_ids()
+        parse(filename, {'node': lambda node_id, coords:
+                         add_border_node(node_id, coords, needed)})
+    else:
+        parse(filename, {'node': add_node, 'way': add_way,
+                         'relation': add_relation})
+    generate_ways()
+
+def needed_node_ids():
+    """Ids of the nodes referenced by relation ways."""
+    needed_ways = set()
+    for members in relations_ways.values():
+        needed_ways.update(members)
+    needed_nodes = set()
+    for i, way_id in enumerate(way_ids):
+        if way_id in needed_ways:
+            needed_nodes.update(way_refs[way_offsets[i]:way_offsets[i + 1]])
+    return needed_nodes
+
+def generate_indexes():
+    """Index relation ids by member way id and features by relation id."""
+    way_relations.clear()
+    relation_features.clear()
+    for country in countries_data:
+        relation_features.setdefault(country['properties']['id'],
+                                     []).append(country)
+    for relation_id, members in relations_ways.items():
+        for way_id in set(members):
+            way_relations.setdefault(way_id, []).append(relation_id)
+
+def generate_ways():
+    generate_indexes()
+    for i, way_id in enumerate(way_ids):
+        relation_ids = way_relations.get(way_id)
+        if not relation_ids:
+            continue
         nodes = []
-        for child in elem.iterchildren():
-            if child.tag == 'nd' and child.get('ref') in border_nodes:
-                nodes.append(border_nodes[child.get('ref')])
+        for ref in way_refs[way_offsets[i]:way_offsets[i + 1]]:
+            if ref in border_nodes:
+                nodes.append(border_nodes[ref])
 
-        for relation_id, way_ids in relations_ways.items():
-            if way_id in way_ids:
-                for country in countries_data:
-                    if country['properties']['id'] == relation_id:
-                        country['geometry']['coordinates'].append(nodes)
-                        country['properties']['count'] += len(nodes)
+        for relation_id in relation_ids:
+            for country in relation_features.get(relation_id, ()):
+                country['geometry']['coordinates'].append(nodes)
+                country['properties']['count'] += len(nodes)
 
-def write(filename):
-    json.dump({"type": "FeatureCollection", "features": countries_data},
-                open(filename, 'wb'))
+def write(filename, precision=None):
+    """Write the features to `filename`, in the format its extension asks
+    for (see geojsonio.write)."""
+    geojsonio.write(filename, countries_data, precision)
 
 def main():
     import argparse
     arg_parser = argparse.ArgumentParser(description="""Simplify a pbf file by
     reducing the number of ways in the map.""")
     arg_parser.add_argument('--src', dest='src', action='store', required=True,
-                   help='Source file. Supports .pbf, .osm and .osm.bz2.')
+                   help='''Source file. Supports .pbf and .osm, optionally
+                   compressed with gzip, bzip2 or xz (.gz, .bz2, .xz).''')
     arg_parser.add_argument('--dst', dest='dst', action='store', required=True,
-                       help='Output .osm file.')
+                       help="""Output GeoJSON file, newline delimited if
+                       it ends in .ndjson or .geojsonl, binary (see
+                       geobin.py) if it ends in .geobin.""")
+    arg_parser.add_argument('--precision', dest='precision', action='store',
+                       type=int,
+                       help='Round coordinates to this many decimals.')
+    arg_parser.add_argument('--needed-nodes-only', dest='needed_only',
+                       action='store_true',
+                       help="""Read the source twice and keep only the
+                       coordinates of boundary nodes. Slower, but memory
+                       scales with the boundaries instead of the file.""")
+    arg_parser.add_argument('--node-store', dest='node_store',
+                       action='store', default='sorted',
+                       choices=nodestore.KINDS,
+                       help="""How node coordinates are held: sorted
+                       arrays (default), dense arrays indexed by node id,
+                       a memory-mapped --node-file, or a plain dict.""")
+    arg_parser.add_argument('--node-file', dest='node_file', action='store',
+                       help='File backing the mmap node store.')
+    arg_parser.add_argument('--relations', dest='relations', action='store',
+                       metavar='EXPRESSION',
+                       type=tagexpr.expression,
+                       help="""Keep only the relations whose tags match
+                       this expression, such as "boundary=administrative
+                       and admin_level<=4" (see tagexpr.py).""")
     args = arg_parser.parse_args()
-    #Parse ways to extract border_nodes. Then get meta_data from border_nodes
-    generate_nodes(args.src)
-    generate_relations(args.src)
-    generate_ways(args.src)
+    if args.node_store == 'mmap' and not args.node_file:
+        arg_parser.error('--node-store mmap needs --node-file')
+    generate(args.src, args.needed_only, args.node_store, args.node_file,
+             args.relations)
 
-    write(args.dst)
+    write(args.dst, args.precision)
 
 if __name__ == '__main__': main()
@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 import os
-from lxml import etree
-from multiprocessing import Process, Queue
-import simplejson as json
-import cPickle
-import math
+import logging
+from array import array
+from itertools import izip
+from multiprocessing import Pool, cpu_count
+from cache import Cache, DEFAULT_DIR
+from state import State
+import geobin
+import geojsonio
+import nodestore
+import osmread
+import sharedarray
+import rings
+import simplify
+import tagexpr
+log = logging.getLogger("parser2")
 
 ###############
 #             #
@@ -12,167 +22,448 @@ import math
 #             #
 ###############
 
-def parse_nodes(src, q):
-    nodes = {}
-    with open(src, 'rb') as sourcefile:
-        for action, elem in etree.iterparse(sourcefile, tag="node"):
-            nodes[int(elem.get('id'))] = (float(elem.get('lon')),
-                                     float(elem.get('lat')))
-    q.put(nodes)
-
-def parse_ways(src, q):
-    ways = {}
-    with open(src, 'rb') as sourcefile:
-        for action, elem in etree.iterparse(sourcefile, tag="way"):
-            way_id = int(elem.get('id'))
-            nodes = []
-            for child in elem.iterchildren():
-                if child.tag == 'nd':
-                    nodes.append(int(child.get('ref')))
-            ways[way_id] = nodes
-    q.put(ways)
-
-def parse_relations(src, q):
+# Node ids a worker keeps, None for all of them (see init_worker)
+needed = None
+# tags -> whether a worker keeps a relation, None to keep all
+keep_relation = None
+
+def init_worker(needed_ids, relation_expression=None):
+    global needed, keep_relation
+    needed = needed_ids
+    keep_relation = None
+    if relation_expression:
+        keep_relation = tagexpr.compile_expression(relation_expression)
+
+def relation_record(tags, members):
+    """What is kept of a relation: its name, ways and inner ways."""
+    relation = {}
+    if 'NAME' in tags:
+        relation['name'] = tags['NAME']
+    relation['ways'] = [ref for member_type, ref, role in members
+                        if member_type == 'way']
+    relation['inner'] = [ref for member_type, ref, role in members
+                         if member_type == 'way' and role == 'inner']
+    return relation
+
+def parse_chunk(task):
+    """Decode one chunk of the source into compact partial results.
+
+    The node store's arrays and the ways as flat arrays (way_refs[
+    way_offsets[i]:way_offsets[i + 1]] are the refs of way_ids[i]) are
+    dumped to `filename` for the parent to attach; only the relations and
+    whether the nodes came sorted travel back through the pool.
+    """
+    src, chunk, kinds, filename = task
+    nodes = nodestore.SortedNodeStore()
+    way_ids = array('l')
+    way_offsets = array('l', [0])
+    way_refs = array('l')
     relations = {}
-    with open(src, 'rb') as sourcefile:
-        for action, elem in etree.iterparse(sourcefile, tag="relation"):
-            relation_id = int(elem.get('id'))
-            relations[relation_id] = {}
-            ways = []
-            for child in elem.iterchildren():
-                if child.tag == 'tag' and child.get('k') == 'NAME':
-                    relations[relation_id]['name'] = child.get('v')
-                if child.tag == 'member' and child.get('type') == 'way':
-                    ways.append(int(child.get('ref')))
-            relations[relation_id]['ways'] = ways
-    q.put(relations)
-
-def reducer(nodes1, nodes2):
-    combined = list(set(nodes1) & set(nodes2))
-    if combined:
-        #if nodes1[-1] == combined[0] and nodes2[0] == combined[0]:
-        #    nodes2.remove(combined[0])
-        #    return nodes1 + nodes2
-        #if nodes1[-1] == combined[0] and nodes2[-1] == combined[0]:
-        #    nodes2.remove(combined[0])
-        #    nodes2.reverse()
-        #    return nodes1 + nodes2
-        #if nodes1[0] == combined[0] and nodes2[-1] == combined[0]:
-        #    nodes1.remove(combined[0])
-        #    return nodes2 + nodes1
-        #if nodes1[0] == combined[0] and nodes2[0] == combined[0]:
-        #    nodes1.remove(combined[0])
-        #    nodes1.reverse()
-        #    return nodes2 + nodes1
-        import pdb; pdb.set_trace()
-    return None
-
-def reduce_ways(lists):
-    if len(lists) <= 1:
-        return lists
-    for i, l1 in enumerate(lists):
-        if len(lists) == 1: break
-        for l2 in lists[i+1:]:
-            if len(lists) == 1: break
-            reduced = reducer(l1, l2)
-            if reduced is not None:
-                if l1 in lists:
-                    lists.remove(l1)
-                if l2 in lists:
-                    lists.remove(l2)
-                lists = reduce_ways(lists + [reduced])
-    return lists
-
-def reduce_ways_dist(lists, nodes, epsilon=.5):
-    if len(lists) <= 1:
-        return lists
-    new_lists = []
-    for i, l1 in enumerate(lists):
-        for l2 in lists[i+1:]:
-            if dist(nodes[l1[0]], nodes[l2[0]]) <= epsilon:
-                import pdb; pdb.set_trace()
-            if dist(nodes[l1[-1]], nodes[l2[-1]]) <= epsilon:
-                import pdb; pdb.set_trace()
-            if dist(nodes[l1[0]], nodes[l2[-1]]) <= epsilon:
-                import pdb; pdb.set_trace()
-            if dist(nodes[l1[-1]], nodes[l2[0]]) <= epsilon:
-                import pdb; pdb.set_trace()
-
-    return lists
-
-def dist(a, b):
-    """Euclidian distance between 2 coordinates"""
-    return math.sqrt(pow(a[0] - b[0], 2) + pow(a[1] - b[1], 2))
-
-def generate_geojson(nodes, ways, relations):
-    data = {
+    for kind, osm_id, value in osmread.read_chunk(src, chunk, kinds):
+        if kind == 'node':
+            if needed is None or osm_id in needed:
+                nodes[osm_id] = value
+        elif kind == 'way':
+            way_ids.append(osm_id)
+            way_refs.extend(value)
+            way_offsets.append(len(way_refs))
+        else:
+            tags, members = value
+            if keep_relation is not None and not keep_relation(tags):
+                continue
+            relations[osm_id] = relation_record(tags, members)
+    sharedarray.dump(filename, nodes.arrays() + (way_ids, way_offsets,
+                                                 way_refs))
+    return nodes.sorted, relations
+
+def parse(src, kinds, jobs, ways, relations, needed_ids=None,
+          relation_expression=None):
+    """Decode `src` chunk by chunk in `jobs` processes, merging ways and
+    relations in file order as they arrive. Only nodes in `needed_ids` are
+    kept if it is given, and only relations matching `relation_expression`
+    (see tagexpr.py).
+
+    Returns the nodes as one read-only SortedNodeStore per chunk, viewing
+    the workers' memory-mapped arrays without copying them.
+    """
+    workdir = sharedarray.workdir()
+    tasks = [(src, chunk, kinds, os.path.join(workdir, str(i)))
+             for i, chunk in enumerate(osmread.chunks(src, jobs * 4))]
+    node_parts = []
+    pool = Pool(jobs, init_worker, (needed_ids, relation_expression))
+    try:
+        results = pool.imap(parse_chunk, tasks)
+        for task, (nodes_sorted, part_relations) in izip(tasks, results):
+            (node_ids, lons, lats, way_ids, way_offsets,
+             way_refs) = sharedarray.attach(task[-1], remove=True)
+            node_parts.append(nodestore.SortedNodeStore.from_arrays(
+                node_ids, lons, lats, nodes_sorted))
+            for i, way_id in enumerate(way_ids):
+                ways[way_id] = way_refs[way_offsets[i]:way_offsets[i + 1]]
+            relations.update(part_relations)
+    finally:
+        pool.close()
+        pool.join()
+        for task in tasks:
+            if os.path.exists(task[-1]):
+                os.remove(task[-1])
+        os.rmdir(workdir)
+    return node_parts
+
+def merge_nodes(node_parts, node_store='sorted', node_file=None):
+    """Combine the per chunk stores parse() returns into one store of kind
+    `node_store`. Sorted stores are chained as they are, not copied."""
+    if node_store == 'sorted':
+        return nodestore.ChainedNodeStore(node_parts)
+    nodes = nodestore.create(node_store, node_file)
+    for part in node_parts:
+        nodestore.merge(nodes, part)
+    return nodes
+
+def used_ways(ways, relations):
+    """The `ways` that `relations` use."""
+    return dict((way_id, ways[way_id])
+                for relation in relations.itervalues()
+                for way_id in relation['ways'] if way_id in ways)
+
+def needed_nodes(ways, relations):
+    """Ids of the nodes referenced by the ways of `relations`."""
+    needed = set()
+    for relation in relations.itervalues():
+        for way_id in relation['ways']:
+            needed.update(ways.get(way_id, ()))
+    return needed
+
+def boundary_nodes(nodes, ways, relations):
+    """A SortedNodeStore of the `nodes` the ways of `relations` use."""
+    needed = needed_nodes(ways, relations)
+    boundary = nodestore.SortedNodeStore()
+    for node_id, coords in nodestore.items(nodes):
+        if node_id in needed:
+            boundary[node_id] = coords
+    return boundary
+
+def way_relations(relations):
+    """Index the ids of `relations` by the ids of their ways."""
+    index = {}
+    for relation_id, relation in relations.iteritems():
+        for way_id in relation['ways']:
+            index.setdefault(way_id, set()).add(relation_id)
+    return index
+
+def apply_changes(filename, nodes, added, ways, relations,
+                  keep_relation=None):
+    """Apply the OSM change file `filename` to the boundary `ways` and
+    `relations` in place, dropping relations `keep_relation` rejects, and
+    add the nodes it creates or moves to the SortedNodeStore `added`.
+    `nodes` are the coordinates so far, those in `added` included.
+    Returns the ids of the relations whose features change.
+
+    The file is read three times: relations first, then the ways they
+    use, then the nodes those ways use. Changes that leave geometry and
+    names alone, such as new tags on a border way, change nothing.
+    """
+    changed = set()
+    for action, kind, relation_id, value in osmread.read_changes(
+            filename, ('relation', )):
+        if action != 'delete' and (keep_relation is None or
+                                   keep_relation(value[0])):
+            relation = relation_record(*value)
+            if relations.get(relation_id) != relation:
+                relations[relation_id] = relation
+                changed.add(relation_id)
+        elif relation_id in relations:
+            del relations[relation_id]
+            changed.add(relation_id)
+    index = way_relations(relations)
+    wanted = set()
+    for action, kind, way_id, refs in osmread.read_changes(filename,
+                                                           ('way', )):
+        if way_id not in index:
+            continue
+        if action == 'delete':
+            if ways.pop(way_id, None) is not None:
+                changed.update(index[way_id])
+        elif list(ways.get(way_id, ())) != refs:
+            ways[way_id] = refs
+            wanted.update(refs)
+            changed.update(index[way_id])
+    moved = {}
+    for action, kind, node_id, coords in osmread.read_changes(filename,
+                                                              ('node', )):
+        if action == 'delete' or not (node_id in wanted or node_id in nodes):
+            continue
+        if nodes.get(node_id) != coords:
+            moved[node_id] = coords
+    # added last, so that `added` is sorted once rather than per lookup
+    for node_id in sorted(moved):
+        added[node_id] = moved[node_id]
+    if moved:
+        moved = set(moved)
+        # ways by their nodes, in one pass rather than through an index
+        # of every node
+        for way_id, refs in ways.iteritems():
+            if way_id in index and not moved.isdisjoint(refs):
+                changed.update(index[way_id])
+    return changed
+
+def written(features, writer):
+    """Yield the (relation id, feature, ...) `features` once `writer` has
+    written each feature."""
+    for item in features:
+        writer.write(item[1])
+        yield item
+
+def update(directory, diffs, dst, precision=None):
+    """Apply the OSM change files `diffs`, in order, to the state in
+    `directory` (see state.py) and write all of its features to `dst`,
+    assembling and simplifying again only those of the relations that
+    changed. The state keeps the parameters it was built with."""
+    state = State(directory)
+    layers, ways, relations, params = state.load()
+    keep = None
+    if params.get('relations'):
+        keep = tagexpr.compile_expression(params['relations'])
+    added = nodestore.SortedNodeStore()
+    changed = set()
+    for diff in diffs:
+        nodes = nodestore.ChainedNodeStore(layers + [added])
+        changed.update(apply_changes(diff, nodes, added, ways, relations,
+                                     keep))
+    nodes = nodestore.ChainedNodeStore(layers + [added])
+    updated = dict((relation_id, relations[relation_id])
+                   for relation_id in changed if relation_id in relations)
+    missing_ways = set(way_id for relation in updated.itervalues()
+                       for way_id in relation['ways'] if way_id not in ways)
+    missing_nodes = [node_id for node_id in needed_nodes(ways, updated)
+                     if node_id not in nodes]
+    if missing_ways or missing_nodes:
+        log.warning("%d ways and %d nodes the changed boundaries use are "
+                    "not in the state; build it again from a full source "
+                    "to include them", len(missing_ways), len(missing_nodes))
+    log.info("Updating %d of %d boundaries", len(changed), len(relations))
+
+    feature_ways = ways
+    if params.get('simplify'):
+        feature_ways = simplify.simplify_ways(
+            used_ways(ways, updated), nodes, params['simplify'],
+            simplify.way_ends(used_ways(ways, relations)))
+    features = dict(relation_features(nodes, feature_ways, updated,
+                                      params.get('snap', 0)))
+
+    def merged():
+        for relation_id, record in state.features():
+            if relation_id not in changed:
+                yield relation_id, geobin.decode(record), record
+            elif relation_id in features:
+                yield relation_id, features.pop(relation_id), None
+        for relation_id in sorted(features):
+            yield relation_id, features[relation_id], None
+
+    with open(dst, 'wb') as fileobj:
+        writer = geojsonio.open_writer(fileobj, dst, precision)
+        state.save(added, used_ways(ways, relations), relations,
+                   written(merged(), writer))
+        writer.close()
+
+def coordinates(ring, nodes):
+    return [nodes[node] for node in ring if node in nodes]
+
+def generate_geojson(nodes, ways, relations, snap=0):
+    """Build a FeatureCollection of the relations' polygons."""
+    return {
         "type": "FeatureCollection",
-        "features": []
+        "features": list(generate_features(nodes, ways, relations, snap))
     }
-    for rel_id, relation in relations.iteritems():
-        coords = []
-        counter = 0
-        for way in reduce_ways([ways[way] for way in relation['ways']]):
-            coords.append([nodes[node] for node in way])
-            counter += len(way)
 
-            #if len(coords) > 1: # See if we can reduce by coordinates as well
+def generate_features(nodes, ways, relations, snap=0):
+    """Yield a feature for the polygons of every relation that has any.
+    With `snap`, way ends that far apart or closer are joined even without
+    a common node."""
+    for rel_id, feature in relation_features(nodes, ways, relations, snap):
+        yield feature
 
-        #if relation['name'] == 'Portugal':
-        #    import pdb; pdb.set_trace()
-        data['features'].append({
+def relation_features(nodes, ways, relations, snap=0):
+    """generate_features() as (relation id, feature) pairs.
+
+    Rings left with too few points once the nodes missing from `nodes`
+    are dropped count as unclosed, and a relation without any other
+    rings has no feature."""
+    for rel_id, relation in relations.iteritems():
+        inner = set(relation.get('inner', ()))
+        outer_rings, unclosed = rings.assemble(
+            [ways[way] for way in relation['ways']
+             if way in ways and way not in inner], nodes, snap)
+        inner_rings, inner_unclosed = rings.assemble(
+            [ways[way] for way in relation['ways']
+             if way in ways and way in inner], nodes, snap)
+        outer_rings, short = rings.valid_rings(
+            [coordinates(ring, nodes) for ring in outer_rings])
+        inner_rings, inner_short = rings.valid_rings(
+            [coordinates(ring, nodes) for ring in inner_rings])
+        unclosed = len(unclosed) + len(inner_unclosed) + short + inner_short
+        name = relation.get('name', str(rel_id))
+        if unclosed:
+            log.warning("%s (relation %d): %d unclosed rings left out", name,
+                        rel_id, unclosed)
+        if not outer_rings and not inner_rings:
+            log.warning("%s (relation %d): no rings left, skipped", name,
+                        rel_id)
+            continue
+        polygons = rings.polygons(outer_rings, inner_rings)
+        counter = sum(len(ring) for polygon in polygons for ring in polygon)
+        if len(polygons) == 1:
+            geometry = {'type': 'Polygon', "coordinates": polygons[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', "coordinates": polygons}
+        yield rel_id, {
             'type': "Feature",
-            'geometry': {
-                'type': 'Polygon',
-                "coordinates": coords
-            },
+            'geometry': geometry,
             'properties': {
-                'name': relation['name'],
-                'count': counter
+                'name': name,
+                'count': counter,
+                'unclosed': unclosed
             }
-        })
-    return data
+        }
 
 def main():
     import argparse
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s "
+                        "%(name)s - %(message)s")
     arg_parser = argparse.ArgumentParser(description="""Simplify a osm file by
     reducibinng the number of ways in the map.""")
-    arg_parser.add_argument('--src', dest='src', action='store', required=True,
-                   help='Source file. Supports .osm')
+    arg_parser.add_argument('--src', dest='src', action='store',
+                   help='''Source file. Supports .osm and .pbf, optionally
+                   compressed with gzip, bzip2 or xz (.gz, .bz2, .xz).
+                   Required unless --apply-diff is given.''')
     arg_parser.add_argument('--dst', dest='dst', action='store', required=True,
-                       help='Output .osm file.')
+                       help="""Output GeoJSON file, newline delimited if
+                       it ends in .ndjson or .geojsonl, binary (see
+                       geobin.py) if it ends in .geobin.""")
+    arg_parser.add_argument('--precision', dest='precision', action='store',
+                       type=int,
+                       help='Round coordinates to this many decimals.')
+    arg_parser.add_argument('--needed-nodes-only', dest='needed_only',
+                       action='store_true',
+                       help="""Parse nodes after ways and relations and keep
+                       only the boundary nodes. Slower, but memory scales
+                       with the boundaries instead of the file.""")
+    arg_parser.add_argument('--node-store', dest='node_store',
+                       action='store', default='sorted',
+                       choices=nodestore.KINDS,
+                       help="""How node coordinates are held: sorted
+                       arrays (default), dense arrays indexed by node id,
+                       a memory-mapped --node-file, or a plain dict.""")
+    arg_parser.add_argument('--node-file', dest='node_file', action='store',
+                       help='File backing the mmap node store.')
+    arg_parser.add_argument('--jobs', dest='jobs', action='store', type=int,
+                       default=cpu_count(),
+                       help="""Number of processes decoding chunks of the
+                       source (default: one per CPU).""")
+    arg_parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+                       default=DEFAULT_DIR,
+                       help="""Where parsed nodes, ways and relations are
+                       cached between runs (default: %(default)s).""")
+    arg_parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+                       help='Parse the source even if it is cached.')
+    arg_parser.add_argument('--no-cache', dest='no_cache',
+                       action='store_true',
+                       help='Neither read nor write the cache.')
+    arg_parser.add_argument('--snap', dest='snap', action='store', type=float,
+                       default=0,
+                       help="""Join way ends that are at most this many
+                       degrees apart, for boundaries with small gaps
+                       between their ways (default: off).""")
+    arg_parser.add_argument('--simplify', dest='tolerance', action='store',
+                       type=float, default=0,
+                       help="""Simplify the boundaries with this
+                       Douglas-Peucker tolerance, in degrees, once per
+                       shared border so neighbours still meet (default:
+                       off).""")
+    arg_parser.add_argument('--relations', dest='relations', action='store',
+                       metavar='EXPRESSION',
+                       type=tagexpr.expression,
+                       help="""Keep only the relations whose tags match
+                       this expression, such as "boundary=administrative
+                       and admin_level<=4" (see tagexpr.py), and only
+                       their ways.""")
+    arg_parser.add_argument('--state', dest='state', action='store',
+                       metavar='DIRECTORY',
+                       help="""Keep the boundaries and what they are built
+                       from in this directory, for --apply-diff to
+                       update them later (see state.py).""")
+    arg_parser.add_argument('--apply-diff', dest='diffs', action='store',
+                       nargs='+', metavar='OSC',
+                       help="""Instead of reading --src, apply these OSM
+                       change files (.osc, optionally compressed), in
+                       order, to the --state and write all of its
+                       boundaries to --dst. Only the boundaries they
+                       change are built again, with the --relations,
+                       --simplify and --snap the state was built with.""")
     args = arg_parser.parse_args()
+    if args.node_store == 'mmap' and not args.node_file:
+        arg_parser.error('--node-store mmap needs --node-file')
+    if args.diffs:
+        if not args.state:
+            arg_parser.error('--apply-diff needs --state')
+        if not State(args.state).exists():
+            arg_parser.error('No state in %s, build one with --src and '
+                             '--state first' % args.state)
+        update(args.state, args.diffs, args.dst, args.precision)
+        return
+    if not args.src:
+        arg_parser.error('--src is required')
 
-    temp_pickle = '/tmp/parser2.pickle'
-    if os.path.exists(temp_pickle):
-        nodes, ways, relations = cPickle.load(open(temp_pickle, 'rb'))
-    else: #Process
-        nodes_q = Queue()
-        ways_q = Queue()
-        relations_q = Queue()
-
-        node_proc = Process(target=parse_nodes, args=(args.src, nodes_q, ))
-        node_proc.start()
-
-        ways_proc = Process(target=parse_ways, args=(args.src, ways_q, ))
-        ways_proc.start()
-
-        relations_proc = Process(target=parse_relations,
-                            args=(args.src, relations_q, ))
-        relations_proc.start()
-
-        nodes = nodes_q.get()
-        node_proc.join()
-
-        ways = ways_q.get()
-        ways_proc.join()
-
-        relations = relations_q.get()
-        relations_proc.join()
-
-        cPickle.dump((nodes, ways, relations, ), open(temp_pickle, 'wb'))
-    json.dump(generate_geojson(nodes, ways, relations), open(args.dst, 'wb'),
-                indent=4)
+    cache = None
+    if not args.no_cache:
+        params = None
+        if args.relations:
+            params = {'relations': args.relations}
+        cache = Cache(args.src, args.cache_dir, params)
+        if args.rebuild:
+            cache.clear()
+    if cache is not None and cache.exists():
+        nodes = merge_nodes([cache.load_nodes()], args.node_store,
+                            args.node_file)
+        ways = cache.load_ways()
+        relations = cache.load_relations()
+    else:
+        ways = {}
+        relations = {}
+        if args.needed_only:
+            parse(args.src, ('way', 'relation'), args.jobs, ways, relations,
+                  relation_expression=args.relations)
+            # Only now do we know which ways and nodes the boundaries use
+            ways = used_ways(ways, relations)
+            node_parts = parse(args.src, ('node', ), args.jobs, ways,
+                               relations, needed_nodes(ways, relations))
+        else:
+            node_parts = parse(args.src, osmread.KINDS, args.jobs, ways,
+                               relations, relation_expression=args.relations)
+            if args.relations:
+                ways = used_ways(ways, relations)
+        nodes = merge_nodes(node_parts, args.node_store, args.node_file)
+        if cache is not None:
+            cache.save(nodes, ways, relations)
+    feature_ways = ways
+    if args.tolerance:
+        feature_ways = simplify.simplify_ways(used_ways(ways, relations),
+                                              nodes, args.tolerance)
+    if args.state is None:
+        geojsonio.write(args.dst, generate_features(
+            nodes, feature_ways, relations, args.snap), args.precision)
+        return
+    features = relation_features(nodes, feature_ways, relations, args.snap)
+    state = State(args.state)
+    with open(args.dst, 'wb') as fileobj:
+        writer = geojsonio.open_writer(fileobj, args.dst, args.precision)
+        ways = used_ways(ways, relations)
+        state.save(boundary_nodes(nodes, ways, relations), ways, relations,
+                   written(((relation_id, feature, None) for relation_id,
+                            feature in features), writer),
+                   {'relations': args.relations, 'simplify': args.tolerance,
+                    'snap': args.snap}, replace=True)
+        writer.close()
 
 if __name__ == '__main__':
     main()
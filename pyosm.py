@@ -3,26 +3,82 @@
 # Original version by Rory McCann (http://blog.technomancy.org/)
 # Modifications by Christoph Lupprich (http://www.stopbeingcarbon.com)
 #
+import gc
+import re
 import xml.sax
-from xml.sax.saxutils import XMLGenerator
+import xml.parsers.expat
+from array import array
+from bisect import bisect_right
+import heapq
+from contextlib import contextmanager
+from collections import MutableMapping, defaultdict
+from itertools import chain, groupby
 import logging
+import compression
 log = logging.getLogger("pyosm")
 
-class Node(object):
-    ATTRIBUTES = ['id', 'timestamp', 'uid', 'user', 'visible', 'version', 'lat', 'lon', 'changeset']
-    def __init__(self, attr, tags=None):
+@contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector. Parsing and merging keep every
+    object they make, which it would only scan over and over as they pile
+    up."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class ReadOnlyTags(dict):
+    """The empty tags compact objects share until they get tags of their
+    own. Changing them would change every object's, so it is refused."""
+    __slots__ = ()
+    def read_only(self, *args, **kwargs):
+        raise TypeError("shared empty tags are read-only, assign a new dict")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = read_only
+
+EMPTY_TAGS = ReadOnlyTags()
+
+def shared(value, strings):
+    """`value` or an equal string already in `strings`, if given."""
+    if strings is None:
+        return value
+    return strings.setdefault(value, value)
+
+# attributes kept whatever the 'keep_attributes' option says
+REQUIRED_ATTRIBUTES = frozenset(['id', 'lat', 'lon'])
+
+def project(attrs, keep):
+    """The attributes in `keep`, plus the required ones, of an element, or
+    all of them if `keep` is None. Objects take defaults for the rest."""
+    if keep is None:
+        return attrs
+    return dict((k, v) for k, v in attrs.items() if k in keep)
+
+class OSMObject(object):
+    """Behaviour shared by nodes, ways and relations, compact or not.
+
+    Subclasses have __slots__ (the Compact* classes) or a __dict__. Compact
+    objects without tags share EMPTY_TAGS and take their repeated strings
+    from a `strings` table, so equal values are stored once.
+    """
+    __slots__ = ()
+    SHARED_TAGS = None
+
+    def init_attributes(self, attr, strings):
         self.id = int(attr['id'])
-        self.lon, self.lat = attr['lon'], attr['lat']
         self.uid = int(attr.get('uid','-1'))
-        self.user = attr.get('user','')
+        self.user = shared(attr.get('user',''), strings)
         self.version = int(attr.get('version','0'))
-        self.timestamp = attr.get('timestamp','')
-        self.visible = attr.get('visible','')
-        self.changeset = attr.get('changeset','')
-        if not tags:
-            self.tags = {}
-        else:
-            self.tags = tags
+        self.timestamp = shared(attr.get('timestamp',''), strings)
+        self.visible = shared(attr.get('visible',''), strings)
+        self.changeset = shared(attr.get('changeset',''), strings)
+
+    def new_tags(self):
+        if self.SHARED_TAGS is None:
+            return {}
+        return self.SHARED_TAGS
 
     def __cmp__(self, other):
         cmp_ref = cmp(self.tags.get('ref',''), other.tags.get('ref',''))
@@ -40,101 +96,242 @@ class Node(object):
                 d[k] = str(v)
         return d
 
+class NodeBase(OSMObject):
+    __slots__ = ()
+    TYPE = 'node'
+    ATTRIBUTES = ['id', 'timestamp', 'uid', 'user', 'visible', 'version', 'lat', 'lon', 'changeset']
+    def __init__(self, attr, tags=None, strings=None):
+        self.init_attributes(attr, strings)
+        self.lon, self.lat = attr['lon'], attr['lat']
+        if not tags:
+            self.tags = self.new_tags()
+        else:
+            self.tags = tags
+
     def __repr__(self):
-        return "Node(attr=%r, tags=%r)" % (self.attributes(), self.tags)
+        return "%s(attr=%r, tags=%r)" % (type(self).__name__, self.attributes(), self.tags)
 
-class Way(object):
+class WayBase(OSMObject):
+    __slots__ = ()
+    TYPE = 'way'
     ATTRIBUTES = ['id', 'timestamp', 'uid', 'user', 'visible', 'version', 'changeset']
-    def __init__(self, attr, nodes=None, tags=None):
-        self.id = int(attr['id'])
-        self.uid = int(attr.get('uid','-1'))
-        self.user = attr.get('user','')
-        self.version = int(attr.get('version','0'))
-        self.timestamp = attr.get('timestamp','')
-        self.visible = attr.get('visible','')
-        self.changeset = attr.get('changeset','')
+    def __init__(self, attr, nodes=None, tags=None, strings=None):
+        self.init_attributes(attr, strings)
 
         if not nodes:
             self.nodes = []
         else:
             self.nodes = nodes
         if not tags:
-            self.tags = {}
+            self.tags = self.new_tags()
         else:
             self.tags = tags
 
-    def __cmp__(self, other):
-        cmp_ref = cmp(self.tags.get('ref',''), other.tags.get('ref',''))
-        if cmp_ref:
-            return cmp_ref
-        cmp_name = cmp(self.tags.get('name',''), other.tags.get('name',''))
-        if cmp_name:
-            return cmp_name
-        return cmp(self.id, other.id)
-
-    def attributes(self):
-        d = dict([(k,getattr(self,k)) for k in self.ATTRIBUTES])
-        for k,v in d.items():
-            if type(v) == int:
-                d[k] = str(v)
-        return d
-
     def __repr__(self):
-        return "Way(attr=%r, nodes=%r, tags=%r)" % (self.attributes(), self.nodes, self.tags)
+        return "%s(attr=%r, nodes=%r, tags=%r)" % (type(self).__name__, self.attributes(), self.nodes, self.tags)
 
-class Relation(object):
+class RelationBase(OSMObject):
+    __slots__ = ()
+    TYPE = 'relation'
     ATTRIBUTES = ['id', 'timestamp', 'uid', 'user', 'visible', 'version', 'changeset']
-    def __init__(self, attr, members=None, tags=None):
-        self.id = int(attr['id'])
-        self.uid = int(attr.get('uid','-1'))
-        self.user = attr.get('user','')
-        self.version = int(attr.get('version','0'))
-        self.timestamp = attr.get('timestamp','')
-        self.visible = attr.get('visible','')
-        self.changeset = attr.get('changeset','')
+    def __init__(self, attr, members=None, tags=None, strings=None):
+        self.init_attributes(attr, strings)
 
         if not members:
             self.members = []
         else:
             self.members = members
         if not tags:
-            self.tags = {}
+            self.tags = self.new_tags()
         else:
             self.tags = tags
 
-    def __cmp__(self, other):
-        cmp_ref = cmp(self.tags.get('ref',''), other.tags.get('ref',''))
-        if cmp_ref:
-            return cmp_ref
-        cmp_name = cmp(self.tags.get('name',''), other.tags.get('name',''))
-        if cmp_name:
-            return cmp_name
-        return cmp(self.id, other.id)
-
-    def attributes(self):
-        d = dict([(k,getattr(self,k)) for k in self.ATTRIBUTES])
-        for k,v in d.items():
-            if type(v) == int:
-                d[k] = str(v)
-        return d
-
     def __repr__(self):
-        return "Relation(attr=%r, members=%r, tags=%r)" % (self.attributes(), self.members, self.tags)
+        return "%s(attr=%r, members=%r, tags=%r)" % (type(self).__name__, self.attributes(), self.members, self.tags)
 
-class ObjectPlaceHolder(object):
+class PlaceHolderBase(object):
+    __slots__ = ()
     def __init__(self, id, type=None, role=''):
         self.id = int(id)
         self.type = type
         self.role = role
 
+    def __repr__(self):
+        return "ObjectPlaceHolder(id=%r, type=%r, role=%r)" % (self.id, self.type, self.role)
+
+    @property
+    def TYPE(self):
+        return self.type
+
+class Node(NodeBase):
+    pass
+
+class Way(WayBase):
+    pass
+
+class Relation(RelationBase):
+    pass
+
+class ObjectPlaceHolder(PlaceHolderBase):
+    def __init__(self, id, type=None, role=''):
+        PlaceHolderBase.__init__(self, id, type, role)
+
         self.tags = {}
         self.nodes = []
         self.members =[]
 
-    def __repr__(self):
-        return "ObjectPlaceHolder(id=%r, type=%r, role=%r)" % (self.id, self.type, self.role)
+SLOTS = ('id', 'uid', 'user', 'version', 'timestamp', 'visible', 'changeset', 'tags')
+
+class CompactNode(NodeBase):
+    __slots__ = SLOTS + ('lon', 'lat')
+    SHARED_TAGS = EMPTY_TAGS
+
+class CompactWay(WayBase):
+    __slots__ = SLOTS + ('nodes', )
+    SHARED_TAGS = EMPTY_TAGS
+
+class CompactRelation(RelationBase):
+    __slots__ = SLOTS + ('members', )
+    SHARED_TAGS = EMPTY_TAGS
+
+class CompactPlaceHolder(PlaceHolderBase):
+    __slots__ = ('id', 'type', 'role')
+    tags = EMPTY_TAGS
+    nodes = ()
+    members = ()
+
+class NodeColumns(MutableMapping):
+    """A mapping of node ids to nodes that stores the nodes column by
+    column instead of as objects, and builds a CompactNode on every
+    lookup. Coordinates are kept as floats and come back as the shortest
+    string of that float, the repeated strings once in `strings`.
+
+    Rows are appended; ids are bisected like in nodestore.SortedNodeStore,
+    sorting the columns first if they did not come in order, and the last
+    row of an id wins. Placeholders for missing nodes are kept aside.
+
+    Ways resolved to their nodes hold a node object per reference, so the
+    columns save the most with load_way_nodes off.
+    """
+    NUMBERS = (('id', 'l'), ('lon', 'd'), ('lat', 'd'), ('uid', 'l'), ('version', 'l'))
+    STRINGS = ('timestamp', 'user', 'visible', 'changeset', 'tags')
+
+    def __init__(self, strings=None):
+        self.strings = {} if strings is None else strings
+        for name, typecode in self.NUMBERS:
+            setattr(self, name, array(typecode))
+        for name in self.STRINGS:
+            setattr(self, name, [])
+        self.placeholders = {}
+        self.deleted = set()
+        self.length = 0
+        self.sorted = True
+
+    def sort(self):
+        # stable, so the last row of an id stays last
+        order = sorted(xrange(len(self.id)), key=self.id.__getitem__)
+        for name, typecode in self.NUMBERS:
+            column = getattr(self, name)
+            setattr(self, name, array(typecode, (column[i] for i in order)))
+        for name in self.STRINGS:
+            column = getattr(self, name)
+            setattr(self, name, [column[i] for i in order])
+        self.sorted = True
+
+    def row(self, node_id):
+        if node_id in self.deleted:
+            return -1
+        if not self.sorted:
+            self.sort()
+        i = bisect_right(self.id, node_id) - 1
+        if i >= 0 and self.id[i] == node_id:
+            return i
+        return -1
+
+    def __getitem__(self, node_id):
+        i = self.row(node_id)
+        if i < 0:
+            return self.placeholders[node_id]
+        node = CompactNode.__new__(CompactNode)
+        for name, typecode in self.NUMBERS:
+            setattr(node, name, getattr(self, name)[i])
+        for name in self.STRINGS:
+            setattr(node, name, getattr(self, name)[i])
+        node.lon = repr(node.lon)
+        node.lat = repr(node.lat)
+        return node
+
+    def __setitem__(self, node_id, node):
+        self.length = None
+        if isinstance(node, PlaceHolderBase):
+            self.placeholders[node_id] = node
+            return
+        self.placeholders.pop(node_id, None)
+        self.deleted.discard(node_id)
+        if self.id and node_id < self.id[-1]:
+            self.sorted = False
+        for name, typecode in self.NUMBERS:
+            value = getattr(node, name)
+            if typecode == 'd':
+                value = float(value)
+            getattr(self, name).append(value)
+        for name in self.STRINGS:
+            value = getattr(node, name)
+            if name == 'tags':
+                value = value or EMPTY_TAGS
+            else:
+                value = shared(value, self.strings)
+            getattr(self, name).append(value)
+
+    def __delitem__(self, node_id):
+        if node_id in self.placeholders:
+            del self.placeholders[node_id]
+        elif self.row(node_id) >= 0:
+            self.deleted.add(node_id)
+        else:
+            raise KeyError(node_id)
+        self.length = None
+
+    def __iter__(self):
+        if not self.sorted:
+            self.sort()
+        for i, node_id in enumerate(self.id):
+            if (i + 1 == len(self.id) or self.id[i + 1] != node_id) and node_id not in self.deleted:
+                yield node_id
+        for node_id in self.placeholders:
+            if self.row(node_id) < 0:
+                yield node_id
+
+    def __len__(self):
+        if self.length is None:
+            self.length = sum(1 for node_id in self)
+        return self.length
+
+CLASSES = (Node, Way, Relation, ObjectPlaceHolder)
+COMPACT_CLASSES = (CompactNode, CompactWay, CompactRelation, CompactPlaceHolder)
 
 class OSMXMLFile(object):
+    """Nodes, ways and relations of an OSM XML file, by id.
+
+    With the 'compact' option objects are Compact* classes with __slots__
+    that share empty tags and repeated strings. With 'columns' the nodes
+    are kept in a NodeColumns mapping instead of as objects.
+
+    The 'engine' option picks the parser, one of ENGINES: 'expat' (the
+    default, OSMExpatParser) or 'sax' (OSMXMLFileParser). Both load the
+    same objects.
+
+    Options also narrow what is built while parsing:
+    keep_attributes  names of the attributes to read besides id, lat and
+                     lon; the others take their defaults (uid -1, '')
+    keep_tags        keys of the tags to keep
+    prefilter        prefilter(name, attrs) on the opening element of a
+                     node, way or relation; elements it rejects are
+                     skipped with everything inside them
+    tagfilter        tagfilter(name, tags) on all the tags of an element,
+                     before any object is built for it
+    filterfunc, the last filter, gets the object itself.
+    """
     def __init__(self, filename=None, content=None, options={}):
         self.filename = filename
 
@@ -142,13 +339,35 @@ class OSMXMLFile(object):
         self.ways = {}
         self.relations = {}
         self.osmattrs = {'version':'0.6'}
+        # (type, id) -> (type, id) of the ways and relations referring to
+        # it, built by the first merge()
+        self.referrers = None
         self.options = {'load_nodes': True,
                         'load_ways': True,
                         'load_relations': True,
                         'load_way_nodes': True,
                         'load_relation_members': True,
-                        'filterfunc': False}
+                        'filterfunc': False,
+                        'prefilter': False,
+                        'tagfilter': False,
+                        'keep_attributes': None,
+                        'keep_tags': None,
+                        'compact': False,
+                        'columns': False,
+                        'engine': 'expat'}
         self.options.update(options)
+        if self.options['compact'] or self.options['columns']:
+            self.strings = {}
+            self.Node, self.Way, self.Relation, self.PlaceHolder = COMPACT_CLASSES
+        else:
+            self.strings = None
+            self.Node, self.Way, self.Relation, self.PlaceHolder = CLASSES
+        if self.options['columns']:
+            self.nodes = NodeColumns(self.strings)
+        if self.options['keep_attributes'] is not None:
+            self.options['keep_attributes'] = REQUIRED_ATTRIBUTES.union(self.options['keep_attributes'])
+        if self.options['keep_tags'] is not None:
+            self.options['keep_tags'] = frozenset(self.options['keep_tags'])
         if filename:
             self.__parse()
         elif content:
@@ -158,17 +377,17 @@ class OSMXMLFile(object):
         if type == "node":
             obj = self.nodes.get(id)
             if not obj:
-                obj = ObjectPlaceHolder(id, type)
+                obj = self.PlaceHolder(id, type)
                 self.nodes[id] = obj
         elif type == "way":
             obj = self.ways.get(id)
             if not obj:
-                obj = ObjectPlaceHolder(id, type)
+                obj = self.PlaceHolder(id, type)
                 self.ways[id] = obj
         elif type == "relation":
             obj = self.relations.get(id)
             if not obj:
-                obj = ObjectPlaceHolder(id, type)
+                obj = self.PlaceHolder(id, type)
                 self.relations[id] = obj
         else:
             log.warn("Don't know type %r in __get_obj", type)
@@ -176,108 +395,116 @@ class OSMXMLFile(object):
 
         return obj
 
+    def store(self, obj):
+        """Keep a parsed node, way or relation under its id."""
+        if obj.TYPE == 'node':
+            self.nodes[obj.id] = obj
+        elif obj.TYPE == 'way':
+            self.ways[obj.id] = obj
+        else:
+            self.relations[obj.id] = obj
+
+    def resolve(self, obj):
+        """Replace the placeholders of a parsed way's nodes or relation's
+        members by the objects stored under their ids, or by placeholders
+        stored in their place."""
+        if isinstance(obj, WayBase):
+            obj.nodes = [self.__get_member(node_pl.id, 'node') for node_pl in obj.nodes]
+        elif isinstance(obj, RelationBase):
+            obj.members = [(self.__get_member(obj_pl.id, obj_pl.type), obj_pl.role) for obj_pl in obj.members]
+
     def __parse(self, content=None):
         """Parse the given XML file"""
-        handler = OSMXMLFileParser(self)
-        if content:
-            xml.sax.parseString(content, handler)
-        else:
-            xml.sax.parse(self.filename, handler)
+        parser = make_parser(self)
+        with gc_paused():
+            for block in read_blocks(self.filename, content):
+                parser.feed(block)
+            parser.close()
 
         # now fix up all the refereneces
         for way in self.ways.values():
-            way.nodes = [self.__get_member(node_pl.id, 'node') for node_pl in way.nodes]
+            if isinstance(way, OSMObject):
+                self.resolve(way)
 
         for relation in self.relations.values():
-            relation.members = [(self.__get_member(obj_pl.id, obj_pl.type), obj_pl.role) for obj_pl in relation.members]
+            if isinstance(relation, OSMObject):
+                self.resolve(relation)
 
     def merge(self, osmxmlfile, update=True):
-        for node in osmxmlfile.nodes.values():
-            self.nodes[node.id] = node
-        for way in osmxmlfile.ways.values():
-            self.ways[way.id] = way
-        for relation in osmxmlfile.relations.values():
-            self.relations[relation.id] = relation
-
-        # now fix up all the references
-        for way in self.ways.values():
-            way.nodes = [self.__get_member(node_pl.id, 'node') for node_pl in way.nodes]
+        """Add the objects of another OSMXMLFile. With `update` its objects
+        replace those with the same ids, otherwise only placeholders are
+        replaced; its placeholders never replace an object.
+
+        Only the ways and relations that are new or refer to an object
+        that changed are resolved again, found through `referrers`, so
+        merging many files one after another stays linear. The index only
+        grows: a stale entry costs a needless resolution, nothing else.
+        """
+        with gc_paused():
+            self.__merge(osmxmlfile, update)
+
+    def __merge(self, osmxmlfile, update):
+        if self.referrers is None:
+            self.referrers = defaultdict(set)
+            for obj in chain(self.ways.values(), self.relations.values()):
+                if isinstance(obj, OSMObject):
+                    self.__index(obj)
+
+        changed = []
+        for mine, theirs in ((self.nodes, osmxmlfile.nodes),
+                             (self.ways, osmxmlfile.ways),
+                             (self.relations, osmxmlfile.relations)):
+            for id, obj in theirs.items():
+                current = mine.get(id)
+                if current is not None:
+                    if isinstance(obj, PlaceHolderBase):
+                        continue
+                    if not update and isinstance(current, OSMObject):
+                        continue
+                mine[id] = obj
+                changed.append((obj.TYPE, id))
+
+        dirty = set()
+        for key in changed:
+            if key[0] != 'node':
+                dirty.add(key)
+            dirty.update(self.referrers.get(key, ()))
+        for kind, id in dirty:
+            if kind == 'way':
+                obj = self.ways[id]
+            else:
+                obj = self.relations[id]
+            if isinstance(obj, OSMObject):
+                self.__refresh(obj)
+                self.__index(obj)
+
+    def __refresh(self, obj):
+        """Point the references of a resolved way or relation at the
+        objects now stored under their ids."""
+        if isinstance(obj, WayBase):
+            obj.nodes = [self.__get_member(node.id, 'node') for node in obj.nodes]
+        else:
+            obj.members = [(self.__get_member(member.id, member.TYPE), role) for member, role in obj.members]
 
-        for relation in self.relations.values():
-            types = {Node: 'node', Way: 'way', Relation: 'relation'}
-            l = relation.members
-            relation.members = []
-            for obj, role in l:
-                t = types.get(type(obj))
-                if not t:
-                    relation.members.append((obj, role))
-                else:
-                    relation.members.append((self.__get_member(obj.id, t), role))
+    def __index(self, obj):
+        key = (obj.TYPE, obj.id)
+        if isinstance(obj, WayBase):
+            for node in obj.nodes:
+                self.referrers[('node', node.id)].add(key)
+        else:
+            for member, role in obj.members:
+                self.referrers[(member.TYPE, member.id)].add(key)
 
     def write(self, fileobj):
-        if type(fileobj) == str:
-            fileobj = open(fileobj, 'wt')
-        handler = XMLGenerator(fileobj, 'UTF-8')
-        handler.startDocument()
-        handler.startElement('osm', self.osmattrs)
-        handler.characters('\n')
-
-        for nodeid in sorted(self.nodes):
-            node = self.nodes[nodeid]
-            if type(node) == ObjectPlaceHolder:
-                continue
-            handler.startElement('node', node.attributes())
-            for name, value in node.tags.items():
-                handler.characters('  ')
-                handler.startElement('tag', {'k': name, 'v': value})
-                handler.endElement('tag')
-                handler.characters('\n')
-            handler.endElement('node')
-            handler.characters('\n')
-
-        for wayid in sorted(self.ways):
-            way = self.ways[wayid]
-            if type(way) == ObjectPlaceHolder:
-                continue
-            handler.startElement('way', way.attributes())
-            handler.characters('\n')
-            for node in way.nodes:
-                handler.characters('  ')
-                handler.startElement('nd', {'ref': node})
-                handler.endElement('nd')
-                handler.characters('\n')
-            for name, value in way.tags.items():
-                handler.characters('  ')
-                handler.startElement('tag', {'k': name, 'v': value})
-                handler.endElement('tag')
-                handler.characters('\n')
-            handler.endElement('way')
-            handler.characters('\n')
-
-        for relationid in sorted(self.relations):
-            relation = self.relations[relationid]
-            if type(relation) == ObjectPlaceHolder:
-                continue
-            handler.startElement('relation', relation.attributes())
-            for obj, role in relation.members:
-                if type(obj) == ObjectPlaceHolder:
-                    obj_type = obj.type
-                else:
-                    obj_type = {Node: 'node', Way: 'way', Relation: 'relation'}[type(obj)]
-                handler.characters('  ')
-                handler.startElement('member', {'type': obj_type, 'ref': str(obj.id), 'role': role})
-                handler.endElement('member')
-                handler.characters('\n')
-            for name, value in relation.tags.items():
-                handler.characters('  ')
-                handler.startElement('tag', {'k': name, 'v': value})
-                handler.endElement('tag')
-                handler.characters('\n')
-            handler.endElement('relation')
-            handler.characters('\n')
-
-        handler.endElement('osm')
-        handler.endDocument()
+        """Write the objects as OSM XML, by kind and id, to a file object
+        or a filename, compressed if it ends in .gz or .bz2."""
+        def objects():
+            for objects in (self.nodes, self.ways, self.relations):
+                for id in sorted(objects):
+                    obj = objects[id]
+                    if not isinstance(obj, PlaceHolderBase):
+                        yield obj
+        write_objects(objects(), fileobj, self.osmattrs)
 
     def statistic(self):
         """Print a short statistic about the osm object"""
@@ -288,15 +515,22 @@ class OSMXMLFile(object):
 
 
 class OSMXMLFileParser(xml.sax.ContentHandler):
-    def __init__(self, containing_obj):
+    def __init__(self, containing_obj, emit=None):
         self.containing_obj = containing_obj
+        self.emit = emit or containing_obj.store
         self.load_nodes = containing_obj.options['load_nodes']
         self.load_ways = containing_obj.options['load_ways']
         self.load_relations = containing_obj.options['load_relations']
         self.load_way_nodes = containing_obj.options['load_way_nodes']
         self.load_relation_members = containing_obj.options['load_relation_members']
         self.filterfunc = containing_obj.options['filterfunc']
+        self.prefilter = containing_obj.options['prefilter']
+        self.tagfilter = containing_obj.options['tagfilter']
+        self.keep_attributes = containing_obj.options['keep_attributes']
+        self.keep_tags = containing_obj.options['keep_tags']
+        self.strings = containing_obj.strings
 
+        self.all_tags = {}
         self.curr_node = None
         self.curr_way = None
         self.curr_relation = None
@@ -304,40 +538,38 @@ class OSMXMLFileParser(xml.sax.ContentHandler):
 
     def startElement(self, name, attrs):
         if name == 'node':
-            if self.load_nodes:
-                self.curr_node = Node(attr=attrs)
+            if self.load_nodes and self.accept(name, attrs):
+                self.curr_node = self.containing_obj.Node(project(attrs, self.keep_attributes), strings=self.strings)
 
         elif name == 'way':
-            if self.load_ways:
-                self.curr_way = Way(attr=attrs)
+            if self.load_ways and self.accept(name, attrs):
+                self.curr_way = self.containing_obj.Way(project(attrs, self.keep_attributes), strings=self.strings)
 
         elif name == "relation":
-            if self.load_relations:
+            if self.load_relations and self.accept(name, attrs):
                 assert self.curr_node is None, "curr_node (%r) is non-none" % (self.curr_node)
                 assert self.curr_way is None, "curr_way (%r) is non-none" % (self.curr_way)
                 assert self.curr_relation is None, "curr_relation (%r) is non-none" % (self.curr_relation)
-                self.curr_relation = Relation(attr=attrs)
+                self.curr_relation = self.containing_obj.Relation(project(attrs, self.keep_attributes), strings=self.strings)
 
         elif name == 'tag':
             if self.curr_node:
-                self.curr_node.tags[attrs['k']] = attrs['v']
+                self.add_tag(self.curr_node, attrs)
             elif self.curr_way:
-                self.curr_way.tags[attrs['k']] = attrs['v']
+                self.add_tag(self.curr_way, attrs)
             elif self.curr_relation:
-                self.curr_relation.tags[attrs['k']] = attrs['v']
+                self.add_tag(self.curr_relation, attrs)
 
         elif name == "nd":
-            if self.load_way_nodes:
+            if self.load_ways and self.load_way_nodes and self.curr_way is not None:
                 assert self.curr_node is None, "curr_node (%r) is non-none" % (self.curr_node)
-                assert self.curr_way is not None, "curr_way is None"
-                self.curr_way.nodes.append(ObjectPlaceHolder(id=attrs['ref']))
+                self.curr_way.nodes.append(self.containing_obj.PlaceHolder(id=attrs['ref']))
 
         elif name == "member":
-            if self.load_relation_members:
+            if self.load_relations and self.load_relation_members and self.curr_relation is not None:
                 assert self.curr_node is None, "curr_node (%r) is non-none" % (self.curr_node)
                 assert self.curr_way is None, "curr_way (%r) is non-none" % (self.curr_way)
-                assert self.curr_relation is not None, "curr_relation is None"
-                self.curr_relation.members.append(ObjectPlaceHolder(id=attrs['ref'], type=attrs['type'], role=attrs['role']))
+                self.curr_relation.members.append(self.containing_obj.PlaceHolder(id=attrs['ref'], type=shared(attrs['type'], self.strings), role=shared(attrs['role'], self.strings)))
 
         elif name == "osm":
             self.curr_osmattrs = attrs
@@ -349,39 +581,380 @@ class OSMXMLFileParser(xml.sax.ContentHandler):
             log.warn("Don't know element %s", name)
 
 
+    def accept(self, name, attrs):
+        """Whether the prefilter lets the element through. Starts
+        collecting its tags for the tagfilter."""
+        if self.prefilter and not self.prefilter(name, attrs):
+            return False
+        self.all_tags = {}
+        return True
+
+    def add_tag(self, obj, attrs):
+        if self.tagfilter:
+            self.all_tags[attrs['k']] = attrs['v']
+        if self.keep_tags is not None and attrs['k'] not in self.keep_tags:
+            return
+        if obj.tags is EMPTY_TAGS:
+            obj.tags = {}
+        obj.tags[shared(attrs['k'], self.strings)] = shared(attrs['v'], self.strings)
+
     def endElement(self, name):
 
         if name == "node":
-            if self.load_nodes:
-                if self.filterfunc:
-                    if not self.filterfunc(self.curr_node):
-                        self.curr_node = None
-                        return
-                self.containing_obj.nodes[self.curr_node.id] = self.curr_node
+            self.finish(name, self.curr_node)
             self.curr_node = None
 
         elif name == "way":
-            if self.load_ways:
-                if self.filterfunc:
-                    if not self.filterfunc(self.curr_way):
-                        self.curr_way = None
-                        return
-                self.containing_obj.ways[self.curr_way.id] = self.curr_way
+            self.finish(name, self.curr_way)
             self.curr_way = None
 
         elif name == "relation":
-            if self.load_relations:
-                if self.filterfunc:
-                    if not self.filterfunc(self.curr_relation):
-                        self.curr_relation = None
-                        return
-                self.containing_obj.relations[self.curr_relation.id] = self.curr_relation
+            self.finish(name, self.curr_relation)
             self.curr_relation = None
 
         elif name == "osm":
             self.containing_obj.osmattrs = self.curr_osmattrs
             self.curr_osmtags = None
 
+    def finish(self, name, obj):
+        """Emit a parsed object, unless it was skipped or is filtered."""
+        if obj is None:
+            return
+        if self.tagfilter and not self.tagfilter(name, self.all_tags):
+            return
+        if self.filterfunc and not self.filterfunc(obj):
+            return
+        self.emit(obj)
+
+
+class OSMExpatParser(object):
+    """What OSMXMLFileParser does, straight on pyexpat.
+
+    Elements are handled through tables of methods set up once from the
+    options, so an element of a kind that is not loaded costs a dict
+    lookup. A node, way or relation is gathered from expat's attribute
+    dicts and built at its end tag, once the prefilter and tagfilter have
+    let it through, so nothing is built for the elements they reject.
+    Feed it the file with feed() and finish with close().
+    """
+    def __init__(self, containing_obj, emit=None):
+        options = containing_obj.options
+        self.containing_obj = containing_obj
+        self.emit = emit or containing_obj.store
+        self.filterfunc = options['filterfunc']
+        self.prefilter = options['prefilter']
+        self.tagfilter = options['tagfilter']
+        self.keep_attributes = options['keep_attributes']
+        self.keep_tags = options['keep_tags']
+        self.strings = containing_obj.strings
+        self.Node = containing_obj.Node
+        self.Way = containing_obj.Way
+        self.Relation = containing_obj.Relation
+        self.PlaceHolder = containing_obj.PlaceHolder
+
+        # attributes, tags and children of the element being parsed
+        self.attrs = None
+        self.tags = None
+        self.children = None
+        self.osmattrs = None
+
+        load_ways = options['load_ways']
+        load_relations = options['load_relations']
+        self.starts = {
+            'node': self.start_object if options['load_nodes'] else self.skip,
+            'way': self.start_object if load_ways else self.skip,
+            'relation': self.start_object if load_relations else self.skip,
+            'tag': self.start_tag,
+            'nd': self.start_child if load_ways and options['load_way_nodes'] else self.ignore,
+            'member': self.start_child if load_relations and options['load_relation_members'] else self.ignore,
+            'osm': self.start_osm,
+            'bound': self.ignore,
+        }
+        self.ends = {'node': self.end_object, 'way': self.end_object,
+                     'relation': self.end_object, 'osm': self.end_osm}
+        self.builders = {'node': self.build_node, 'way': self.build_way,
+                         'relation': self.build_relation}
+
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def close(self):
+        self.parser.Parse('', True)
+
+    def start(self, name, attrs):
+        handler = self.starts.get(name)
+        if handler is None:
+            log.warn("Don't know element %s", name)
+        else:
+            handler(name, attrs)
+
+    def end(self, name):
+        handler = self.ends.get(name)
+        if handler is not None:
+            handler(name)
+
+    def skip(self, name, attrs):
+        self.attrs = None
+
+    def ignore(self, name, attrs):
+        pass
+
+    def start_object(self, name, attrs):
+        if self.prefilter and not self.prefilter(name, attrs):
+            self.attrs = None
+            return
+        self.attrs = attrs
+        self.tags = {}
+        self.children = []
+
+    def start_tag(self, name, attrs):
+        if self.attrs is not None:
+            self.tags[attrs['k']] = attrs['v']
+
+    def start_child(self, name, attrs):
+        if self.attrs is not None:
+            self.children.append(attrs)
+
+    def start_osm(self, name, attrs):
+        self.osmattrs = attrs
+
+    def end_object(self, name):
+        attrs = self.attrs
+        if attrs is None:
+            return
+        self.attrs = None
+        if self.tagfilter and not self.tagfilter(name, self.tags):
+            return
+        obj = self.builders[name](project(attrs, self.keep_attributes),
+                                  self.kept_tags(), self.children)
+        if not self.filterfunc or self.filterfunc(obj):
+            self.emit(obj)
+
+    def end_osm(self, name):
+        self.containing_obj.osmattrs = self.osmattrs
+
+    def kept_tags(self):
+        strings = self.strings
+        keep = self.keep_tags
+        return dict((shared(k, strings), shared(v, strings))
+                    for k, v in self.tags.iteritems()
+                    if keep is None or k in keep)
+
+    def build_node(self, attrs, tags, children):
+        return self.Node(attrs, tags, self.strings)
+
+    def build_way(self, attrs, tags, children):
+        PlaceHolder = self.PlaceHolder
+        return self.Way(attrs, [PlaceHolder(child['ref']) for child in children], tags, self.strings)
+
+    def build_relation(self, attrs, tags, children):
+        PlaceHolder = self.PlaceHolder
+        strings = self.strings
+        members = [PlaceHolder(child['ref'], shared(child['type'], strings), shared(child['role'], strings))
+                   for child in children]
+        return self.Relation(attrs, members, tags, strings)
+
+def sax_parser(containing_obj, emit=None):
+    """An incremental xml.sax parser with an OSMXMLFileParser."""
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(OSMXMLFileParser(containing_obj, emit))
+    return parser
+
+ENGINES = {'expat': OSMExpatParser, 'sax': sax_parser}
+
+def make_parser(containing_obj, emit=None):
+    """A parser with feed() and close() that hands the objects it parses
+    to emit(), by default containing_obj.store(), using the engine
+    containing_obj's options ask for."""
+    engine = containing_obj.options['engine']
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine %r, use one of %s"
+                         % (engine, ', '.join(sorted(ENGINES))))
+    return ENGINES[engine](containing_obj, emit)
+
+ESCAPES = ((u'&', u'&amp;'), (u'<', u'&lt;'), (u'>', u'&gt;'), (u'"', u'&quot;'),
+           (u'\n', u'&#10;'), (u'\r', u'&#13;'), (u'\t', u'&#9;'))
+NEEDS_ESCAPE = re.compile(u'[&<>"\n\r\t]')
+
+def escape(value):
+    """`value` as the text of an XML attribute. Numbers come back as
+    they are, for %s to format."""
+    if not isinstance(value, basestring) or NEEDS_ESCAPE.search(value) is None:
+        return value
+    for char, entity in ESCAPES:
+        value = value.replace(char, entity)
+    return value
+
+# opening tags of each kind, for % with the escaped ATTRIBUTES
+OPENING_TAGS = dict((base.TYPE, u'<%s %s' % (base.TYPE, u' '.join(u'%s="%%s"' % name for name in base.ATTRIBUTES)))
+                    for base in (NodeBase, WayBase, RelationBase))
+
+class OSMWriter(object):
+    """Write nodes, ways and relations as OSM XML to `fileobj`.
+
+    The text of every object is built in one go from OPENING_TAGS and
+    collected, then written UTF-8 encoded every BUFFER pieces, instead of
+    going through an XMLGenerator call per element. Relation members may
+    be (object, role) pairs or, as iterparse() yields them, placeholders
+    with their role. close() ends the document; it does not close
+    `fileobj`.
+    """
+    BUFFER = 16384
+
+    def __init__(self, fileobj, osmattrs=None):
+        self.fileobj = fileobj
+        self.count = 0
+        if osmattrs is None:
+            osmattrs = {'version': '0.6'}
+        self.chunks = [u'<?xml version="1.0" encoding="UTF-8"?>\n<osm%s>\n' % u''.join(
+            u' %s="%s"' % (name, escape(value)) for name, value in sorted(osmattrs.items()))]
+
+    def write(self, obj):
+        chunks = self.chunks
+        append = chunks.append
+        kind = obj.TYPE
+        append(OPENING_TAGS[kind] % tuple([escape(getattr(obj, name)) for name in obj.ATTRIBUTES]))
+        if kind == 'node' and not obj.tags:
+            append(u'/>\n')
+        else:
+            append(u'>\n')
+            if kind == 'way':
+                for node in obj.nodes:
+                    append(u'  <nd ref="%d"/>\n' % node.id)
+            elif kind == 'relation':
+                for member in obj.members:
+                    if isinstance(member, tuple):
+                        member, role = member
+                    else:
+                        role = member.role
+                    append(u'  <member type="%s" ref="%d" role="%s"/>\n' % (member.TYPE, member.id, escape(role)))
+            for name, value in obj.tags.items():
+                append(u'  <tag k="%s" v="%s"/>\n' % (escape(name), escape(value)))
+            append(u'</%s>\n' % kind)
+        self.count += 1
+        if len(chunks) >= self.BUFFER:
+            self.flush()
+
+    def flush(self):
+        self.fileobj.write(u''.join(self.chunks).encode('utf-8'))
+        del self.chunks[:]
+
+    def close(self):
+        self.chunks.append(u'</osm>\n')
+        self.flush()
+
+def write_objects(objects, fileobj, osmattrs=None):
+    """Write the iterable `objects`, in its order, as OSM XML to a file
+    object or a filename, which is compressed in a background thread if
+    it ends in .gz or .bz2 (see compression.py). Returns the number of
+    objects written.
+
+    Objects are written as they come, so the stream of iterparse() or
+    iter_merged() is written in constant memory."""
+    if isinstance(fileobj, basestring):
+        output = compression.open_output(fileobj)
+    else:
+        output = fileobj
+    try:
+        writer = OSMWriter(output, osmattrs)
+        for obj in objects:
+            writer.write(obj)
+        writer.close()
+    finally:
+        if output is not fileobj:
+            output.close()
+    return writer.count
+
+# bytes fed to the parser at once
+BLOCK = 64 * 1024
+
+def read_blocks(filename=None, content=None):
+    """Yield `content`, or the content of `filename` BLOCK bytes at a
+    time, decompressed if it ends in .gz, .bz2 or .xz."""
+    if content:
+        yield content
+        return
+    with compression.open_input(filename) as source:
+        for block in iter(lambda: source.read(BLOCK), ''):
+            yield block
+
+def iterparse(filename=None, content=None, options={}, resolve=False):
+    """Yield the nodes, ways and relations of an OSM XML file, in file
+    order, as soon as each is parsed.
+
+    The options are OSMXMLFile's. Without `resolve` ways' nodes and
+    relations' members are left as placeholders with the ids (and roles),
+    and nothing is kept, so memory does not grow with the file. With
+    `resolve` they are the objects yielded before them, or placeholders,
+    as after OSMXMLFile's parsing; every object is then kept to resolve
+    the ones after it.
+    """
+    osm = OSMXMLFile(options=options)
+    parsed = []
+    parser = make_parser(osm, parsed.append)
+    # None closes the parser, which may hand over the last objects
+    for block in chain(read_blocks(filename, content), [None]):
+        if block is None:
+            parser.close()
+        else:
+            parser.feed(block)
+        for obj in parsed:
+            if resolve:
+                osm.resolve(obj)
+                osm.store(obj)
+            yield obj
+        del parsed[:]
+
+def iter_nodes(filename=None, content=None, options={}):
+    """Yield the nodes of an OSM XML file as they are parsed."""
+    options = dict(options, load_ways=False, load_relations=False)
+    return iterparse(filename, content, options)
+
+def iter_ways(filename=None, content=None, options={}, resolve=False):
+    """Yield the ways of an OSM XML file as they are parsed, with their
+    nodes if `resolve` (see iterparse)."""
+    options = dict(options, load_nodes=resolve, load_relations=False)
+    return (obj for obj in iterparse(filename, content, options, resolve)
+            if obj.TYPE == 'way')
+
+def iter_relations(filename=None, content=None, options={}, resolve=False):
+    """Yield the relations of an OSM XML file as they are parsed, with
+    their members if `resolve` (see iterparse)."""
+    options = dict(options, load_nodes=resolve, load_ways=resolve)
+    return (obj for obj in iterparse(filename, content, options, resolve)
+            if obj.TYPE == 'relation')
+
+
+# order of the kinds in a sorted OSM file
+KIND_ORDER = {'node': 0, 'way': 1, 'relation': 2}
+
+def iter_merged(filenames, options={}):
+    """Yield the objects of several sorted OSM XML files (nodes, then
+    ways, then relations, each by id) as one sorted stream, reading each
+    file as it goes, so only one object per file is held.
+
+    An object in several files comes out once: the highest version, or
+    the one from the last of the files holding it. Ways' nodes and
+    relations' members are placeholders, as from iterparse().
+    """
+    def keyed(i, filename):
+        for obj in iterparse(filename, options=options):
+            yield KIND_ORDER[obj.TYPE], obj.id, i, obj
+    streams = [keyed(i, filename) for i, filename in enumerate(filenames)]
+    for key, copies in groupby(heapq.merge(*streams), lambda item: item[:2]):
+        yield max(copies, key=lambda item: (item[3].version, item[2]))[3]
+
+def merge_sorted(filenames, fileobj, options={}):
+    """Write the iter_merged() stream of sorted OSM XML files to
+    `fileobj`, as write_objects() does. Returns the number of objects
+    written."""
+    return write_objects(iter_merged(filenames, options), fileobj,
+                         {'version': '0.6', 'generator': 'pyosm'})
+
 
 #################### MAIN
 if __name__ == '__main__':
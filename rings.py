@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Assemble the ways of a boundary relation into polygons.
+
+Ways are joined end to end through an index of their first and last node
+ids, so a relation with n ways is assembled in O(n) however they are
+ordered or oriented.
+
+>>> rings, unclosed = assemble([[1, 2, 3], [5, 4, 3], [5, 1], [7, 8]])
+>>> rings, unclosed
+([[1, 2, 3, 4, 5, 1]], [[7, 8]])
+
+With a tolerance, ends that share no node are also joined when they lie
+within that distance, found through a grid over the ends' coordinates:
+
+>>> nodes = {1: (0, 0), 2: (1, 0), 3: (1.01, 0), 4: (1, 1), 5: (0, .01)}
+>>> assemble([[1, 2], [3, 4, 5]], nodes)[0]
+[]
+>>> assemble([[1, 2], [3, 4, 5]], nodes, tolerance=.05)[0]
+[[1, 2, 3, 4, 5, 1]]
+>>> square = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)]
+>>> hole = [(1, 1), (2, 1), (2, 2), (1, 1)]
+>>> island = [(8, 8), (9, 8), (9, 9), (8, 8)]
+>>> polygons([square, island], [hole]) == [[square, hole], [island]]
+True
+
+Rings that lost nodes, e.g. to the edge of an extract, may be too short
+to be rings at all, which valid_rings() drops:
+
+>>> valid_rings([square, [], [(0, 0), (1, 0), (0, 0)]]) == ([square], 2)
+True
+"""
+import math
+from collections import defaultdict
+
+# points of the smallest ring, a triangle and its first point again
+MIN_POINTS = 4
+
+
+def dist(a, b):
+    """Euclidian distance between 2 coordinates"""
+    return math.sqrt(pow(a[0] - b[0], 2) + pow(a[1] - b[1], 2))
+
+
+class EndpointGrid(object):
+    """Uniform grid of `tolerance` wide cells over way ends, so the ends
+    within `tolerance` of a point are all in the 3x3 cells around it."""
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.cells = defaultdict(list)
+
+    def cell(self, point):
+        return (int(math.floor(point[0] / self.tolerance)),
+                int(math.floor(point[1] / self.tolerance)))
+
+    def add(self, point, item):
+        self.cells[self.cell(point)].append((point, item))
+
+    def nearest(self, point, accept):
+        """The closest item within tolerance for which accept(item) holds,
+        or None."""
+        x, y = self.cell(point)
+        best = None
+        best_dist = self.tolerance
+        for cell in ((x + dx, y + dy) for dx in (-1, 0, 1)
+                     for dy in (-1, 0, 1)):
+            for other, item in self.cells.get(cell, ()):
+                if accept(item):
+                    distance = dist(point, other)
+                    if distance <= best_dist:
+                        best, best_dist = item, distance
+        return best
+
+
+def assemble(ways, nodes=None, tolerance=0):
+    """Join lists of node ids into closed rings.
+
+    Ways may run in either direction. Returns (rings, unclosed), the
+    closed rings and the chains whose ends did not meet.
+
+    With a `tolerance` and the `nodes` coordinates, a chain that has no
+    way sharing its end node continues with the way whose end is nearest
+    within tolerance, and closes if its own start is that near.
+    """
+    segments = [way for way in ways if len(way) > 1]
+    used = [False] * len(segments)
+    ends = defaultdict(list)
+    for i, segment in enumerate(segments):
+        ends[segment[0]].append(i)
+        ends[segment[-1]].append(i)
+
+    grid = None
+    if tolerance:
+        grid = EndpointGrid(tolerance)
+        for i, segment in enumerate(segments):
+            for node_id in (segment[0], segment[-1]):
+                if node_id in nodes:
+                    grid.add(nodes[node_id], i)
+
+    def next_segment(node_id):
+        candidates = ends.get(node_id)
+        while candidates:
+            i = candidates.pop()
+            if not used[i]:
+                return i
+        return None
+
+    def closes(ring):
+        return (len(ring) > 3 and ring[0] in nodes and ring[-1] in nodes and
+                dist(nodes[ring[0]], nodes[ring[-1]]) <= tolerance)
+
+    def snap(ring):
+        """Append the way with an end nearest to the ring's end, return
+        whether there was one."""
+        if ring[-1] not in nodes:
+            return False
+        end = nodes[ring[-1]]
+        i = grid.nearest(end, lambda i: not used[i])
+        if i is None:
+            return False
+        used[i] = True
+        following = segments[i]
+        first = nodes.get(following[0])
+        last = nodes.get(following[-1])
+        if last is None or (first is not None and
+                            dist(end, first) <= dist(end, last)):
+            ring.extend(following)
+        else:
+            ring.extend(reversed(following))
+        return True
+
+    rings = []
+    unclosed = []
+    for i, segment in enumerate(segments):
+        if used[i]:
+            continue
+        used[i] = True
+        ring = list(segment)
+        reversed_once = False
+        while ring[0] != ring[-1]:
+            j = next_segment(ring[-1])
+            if j is not None:
+                used[j] = True
+                following = segments[j]
+                if following[0] == ring[-1]:
+                    ring.extend(following[1:])
+                else:
+                    ring.extend(reversed(following[:-1]))
+            elif grid is not None and closes(ring):
+                ring.append(ring[0])
+            elif grid is not None and snap(ring):
+                pass
+            elif not reversed_once:
+                # stuck at this end, carry on from the other one
+                ring.reverse()
+                reversed_once = True
+            else:
+                break
+        if reversed_once:
+            ring.reverse()
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+        else:
+            unclosed.append(ring)
+    return rings, unclosed
+
+
+def contains(ring, point):
+    """Whether `point` lies inside the ring of coordinates (ray casting)."""
+    x, y = point[0], point[1]
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if ((y1 > y) != (y2 > y) and
+                x < x1 + (y - y1) * (x2 - x1) / float(y2 - y1)):
+            inside = not inside
+    return inside
+
+
+def valid_rings(rings):
+    """The rings of coordinates with at least MIN_POINTS points, and the
+    number of the others."""
+    valid = [ring for ring in rings if len(ring) >= MIN_POINTS]
+    return valid, len(rings) - len(valid)
+
+def polygons(outer, inner):
+    """Group rings of coordinates into GeoJSON polygons: every outer ring
+    followed by the inner rings inside it. An inner ring that no outer
+    ring contains becomes a polygon of its own."""
+    result = [[ring] for ring in outer]
+    for ring in inner:
+        for polygon in result[:len(outer)]:
+            if contains(polygon[0], ring[0]):
+                polygon.append(ring)
+                break
+        else:
+            result.append([ring])
+    return result
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
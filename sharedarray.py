@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Hand arrays between processes through memory-mapped files.
+
+dump() writes arrays raw, after a small header of typecodes and lengths,
+and attach() maps the file and returns ctypes arrays viewing the mapping,
+so the receiving process neither unpickles nor copies anything. Files go
+to /dev/shm when it exists, which keeps them in memory.
+
+>>> from array import array
+>>> directory = workdir()
+>>> filename = os.path.join(directory, 'example')
+>>> dump(filename, [array('l', [1, 2, 3]), array('i'), array('d', [.5])])
+>>> ids, empty, values = attach(filename, remove=True)
+>>> list(ids), len(empty), values[0]
+([1, 2, 3], 0, 0.5)
+>>> os.rmdir(directory)
+"""
+import ctypes
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+CTYPES = {'l': ctypes.c_long, 'i': ctypes.c_int, 'I': ctypes.c_uint,
+          'd': ctypes.c_double}
+ALIGN = 8
+HEADER = struct.Struct('<I')
+
+
+def workdir():
+    """A new temporary directory for dumped arrays, in memory if possible."""
+    shm = '/dev/shm'
+    return tempfile.mkdtemp(prefix='osm-', dir=shm if os.path.isdir(shm)
+                            else None)
+
+
+def padding(offset):
+    return -offset % ALIGN
+
+
+def dump(filename, arrays):
+    """Write `arrays` (array.array objects) to `filename`."""
+    header = ' '.join('%s%d' % (values.typecode, len(values))
+                      for values in arrays).encode('ascii')
+    with open(filename, 'wb') as fileobj:
+        fileobj.write(HEADER.pack(len(header)) + header)
+        fileobj.write(b'\0' * padding(HEADER.size + len(header)))
+        for values in arrays:
+            values.tofile(fileobj)
+            fileobj.write(b'\0' * padding(len(values) * values.itemsize))
+
+
+def attach(filename, remove=False):
+    """Map `filename` as written by dump() and return ctypes arrays
+    viewing it. The mapping is private, writes do not reach the file, and
+    it stays valid after the file is removed, which `remove` does."""
+    with open(filename, 'rb') as fileobj:
+        mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_COPY)
+    if remove:
+        os.remove(filename)
+    size = HEADER.unpack_from(mapping, 0)[0]
+    header = mapping[HEADER.size:HEADER.size + size].decode('ascii')
+    offset = HEADER.size + size
+    offset += padding(offset)
+    arrays = []
+    for spec in header.split():
+        ctype = CTYPES[spec[0]]
+        count = int(spec[1:])
+        arrays.append((ctype * count).from_buffer(mapping, offset))
+        offset += count * ctypes.sizeof(ctype)
+        offset += padding(offset)
+    return arrays
+
+
+def to_array(typecode, values):
+    """Copy `values`, an array.array or an attached ctypes array, into an
+    array.array."""
+    if isinstance(values, array):
+        return values
+    result = array(typecode)
+    result.fromstring(buffer(values))
+    return result
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
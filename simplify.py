@@ -1,19 +1,292 @@
-import sys
-import simplejson as json
-from dp import simplify_points
+#!/usr/bin/env python
+"""Simplify the boundaries of a GeoJSON file with Douglas-Peucker.
 
-def main(filename, output):
-    data = json.load(open(filename, 'rb'))
-    for polygon in data['features']:
+With several jobs the rings are flattened into one array of coordinates
+that the worker processes map through sharedarray, in batches of about
+the same number of points. Workers send back only the indices of the
+points they keep, so the output holds the very same coordinates, in the
+same order, as a single process would write.
+
+significance() stores the tolerance every point drops out at instead,
+from which simplify() produces any tolerance by filtering.
+
+simplify_ways() simplifies parser2's ways instead, once per shared
+border; see parser2.py --simplify.
+
+main() reads and writes features through geojsonio, simplifying them in
+windows of about WINDOW points, so memory does not grow with the input.
+"""
+import copy
+import os
+from array import array
+from multiprocessing import Pool, cpu_count
+import dp
+from dp import simplify_indices
+import geojsonio
+import sharedarray
+
+TOLERANCE = .15
+# points read and simplified at once
+WINDOW = 1000000
+
+def polygons(geometry):
+    """The polygons of a Polygon or MultiPolygon geometry."""
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return [geometry['coordinates']]
+
+def rings(features):
+    """Every ring of every feature, in file order, as (rings, i) pairs
+    where rings[i] is the ring."""
+    for feature in features:
+        for polygon in polygons(feature['geometry']):
+            for i in range(len(polygon)):
+                yield polygon, i
+
+def flatten(features):
+    """The coordinates of all the rings as one array of x, y pairs, and
+    the offsets of the rings' first points (plus the total)."""
+    coords = array('d')
+    offsets = array('l', [0])
+    for polygon, i in rings(features):
+        for point in polygon[i]:
+            coords.append(point[0])
+            coords.append(point[1])
+        offsets.append(len(coords) // 2)
+    return coords, offsets
+
+def batches(offsets, count):
+    """Split the rings into about `count` (first, last) ranges of about
+    the same number of points. A ring is never split."""
+    total = offsets[-1]
+    ranges = []
+    first = 0
+    for ring in range(1, len(offsets)):
+        if offsets[ring] * count >= total * (len(ranges) + 1):
+            ranges.append((first, ring))
+            first = ring
+    if first < len(offsets) - 1:
+        ranges.append((first, len(offsets) - 1))
+    return ranges
+
+def simplify_ring(points, tolerance):
+    """The indices of the points of a ring kept at `tolerance`, or with a
+    tolerance of None the significance of every point (see
+    dp.significance)."""
+    if tolerance is None:
+        return dp.significance(points)
+    return simplify_indices(points, tolerance)
+
+def simplify_batch(task):
+    """simplify_ring() the rings first to last of the flattened rings in
+    `filename` and dump the results to `output`."""
+    filename, first, last, tolerance, output = task
+    coords, offsets = sharedarray.attach(filename)
+    results = array('d' if tolerance is None else 'l')
+    result_offsets = array('l', [0])
+    for ring in range(first, last):
+        flat = coords[2 * offsets[ring]:2 * offsets[ring + 1]]
+        results.extend(simplify_ring(zip(flat[::2], flat[1::2]), tolerance))
+        result_offsets.append(len(results))
+    sharedarray.dump(output, (results, result_offsets))
+    return output
+
+def simplify_rings(features, tolerance, jobs=1):
+    """Yield simplify_ring() of every ring, in file order."""
+    if jobs > 1:
+        return simplify_parallel(features, tolerance, jobs)
+    return (simplify_ring(polygon[i], tolerance)
+            for polygon, i in rings(features))
+
+def simplify_parallel(features, tolerance, jobs):
+    """simplify_rings() in `jobs` processes."""
+    coords, offsets = flatten(features)
+    workdir = sharedarray.workdir()
+    filename = os.path.join(workdir, 'rings')
+    sharedarray.dump(filename, (coords, offsets))
+    del coords
+    tasks = [(filename, first, last, tolerance,
+              os.path.join(workdir, str(i)))
+             for i, (first, last) in enumerate(batches(offsets, jobs * 4))]
+    pool = Pool(jobs)
+    try:
+        for output in pool.imap(simplify_batch, tasks):
+            results, offsets = sharedarray.attach(output, remove=True)
+            for i in range(len(offsets) - 1):
+                yield results[offsets[i]:offsets[i + 1]]
+    finally:
+        pool.close()
+        pool.join()
+        for task in tasks:
+            if os.path.exists(task[-1]):
+                os.remove(task[-1])
+        os.remove(filename)
+        os.rmdir(workdir)
+
+def way_ends(ways):
+    """The first and last nodes of the ways (id -> node ids)."""
+    ends = set()
+    for refs in ways.itervalues():
+        if refs:
+            ends.update((refs[0], refs[-1]))
+    return ends
+
+def simplify_ways(ways, nodes, tolerance=TOLERANCE, ends=None):
+    """Simplify the ways (id -> node ids) of boundaries before they are
+    assembled into rings, instead of every feature's rings afterwards.
+
+    Ways are cut into arcs at the nodes where another way ends, so the
+    points borders meet at always stay, and every arc is simplified once
+    however many features use it. Neighbours thus keep exactly the same
+    border, without gaps or slivers. Returns id -> kept node ids.
+
+    `ends` are the nodes to cut at, by default way_ends(ways); when only
+    some ways are simplified again they are the ends of all of them.
+    """
+    if ends is None:
+        ends = way_ends(ways)
+    simplified = {}
+    for way_id, refs in ways.iteritems():
+        refs = [ref for ref in refs if ref in nodes]
+        kept = refs[:1]
+        start = 0
+        for i in range(1, len(refs)):
+            if refs[i] in ends or i == len(refs) - 1:
+                arc = refs[start:i + 1]
+                indices = simplify_indices([nodes[ref] for ref in arc],
+                                           tolerance)
+                # the arc's first node ends the previous one
+                kept.extend(arc[j] for j in indices[1:])
+                start = i
+        simplified[way_id] = kept
+    return simplified
+
+def significance(features, jobs=1):
+    """Add the significance of every point to the `features`, as a
+    'significance' property holding one list per ring, in the order of
+    the feature's rings. The ends of rings, which never drop out, have a
+    significance of None."""
+    results = simplify_rings(features, None, jobs)
+    for feature in features:
+        feature['properties']['significance'] = [
+            [None if value == float('inf') else value
+             for value in next(results)]
+            for polygon in polygons(feature['geometry'])
+            for ring in polygon]
+
+def filter_significance(features, tolerance):
+    """The indices of the points kept at `tolerance` in every ring, from
+    what significance() stored, which is then dropped."""
+    ring_values = [values for feature in features
+                   for values in feature['properties'].pop('significance')]
+    return ([i for i, value in enumerate(values)
+             if value is None or value > tolerance]
+            for values in ring_values)
+
+def simplify(features, tolerance=TOLERANCE, jobs=1):
+    """Simplify the rings of the GeoJSON `features` in place and count
+    the points left in each feature. Features carrying their significance
+    are simplified by filtering it."""
+    if features and all('significance' in feature['properties']
+                        for feature in features):
+        kept = filter_significance(features, tolerance)
+    else:
+        kept = simplify_rings(features, tolerance, jobs)
+    for feature in features:
         counter = 0
-        coords = []
-        for coordinates in polygon['geometry']['coordinates']:
-            points = simplify_points(coordinates, .15)
-            counter += len(points)
-            coords.append(points)
-        polygon['geometry']['coordinates'] = coords
-        polygon['properties']['count'] = counter
-    json.dump(data, open(output, 'wb'), indent=4)
+        for polygon in polygons(feature['geometry']):
+            for i, coordinates in enumerate(polygon):
+                points = [coordinates[j] for j in next(kept)]
+                counter += len(points)
+                polygon[i] = points
+        feature['properties']['count'] = counter
+
+def windows(features, size=WINDOW):
+    """Group the iterable `features` into lists of about `size` points."""
+    window = []
+    points = 0
+    for feature in features:
+        window.append(feature)
+        points += sum(len(ring) for polygon in polygons(feature['geometry'])
+                      for ring in polygon)
+        if points >= size:
+            yield window
+            window = []
+            points = 0
+    if window:
+        yield window
+
+def each_window(features, process):
+    """Yield the `features` after process() has run on every window of
+    them."""
+    for window in windows(features):
+        process(window)
+        for feature in window:
+            yield feature
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="""Simplify the
+    boundaries of a GeoJSON file.""")
+    arg_parser.add_argument('src', help="""Source GeoJSON file, newline
+                            delimited if it ends in .ndjson or .geojsonl,
+                            binary if it ends in .geobin.""")
+    arg_parser.add_argument('dst', help="""Output GeoJSON file, newline
+                            delimited if it ends in .ndjson or .geojsonl,
+                            binary if it ends in .geobin.""")
+    arg_parser.add_argument('--tolerance', dest='tolerance', action='store',
+                       type=float, default=TOLERANCE,
+                       help="""Largest distance, in degrees, of a dropped
+                       point from the simplified line (default:
+                       %(default)s).""")
+    arg_parser.add_argument('--jobs', dest='jobs', action='store', type=int,
+                       default=cpu_count(),
+                       help="""Number of processes simplifying rings
+                       (default: one per CPU).""")
+    arg_parser.add_argument('--levels', dest='levels', action='store',
+                       type=lambda value: [float(level) for level
+                                           in value.split(',')],
+                       help="""Comma separated tolerances to write one
+                       output for each of, from a single pass: dst with the
+                       tolerance before its extension.""")
+    arg_parser.add_argument('--significance', dest='significance',
+                       action='store_true',
+                       help="""Write the features unsimplified, with the
+                       tolerance every point drops out at, so that this
+                       script can later simplify them at any tolerance by
+                       filtering.""")
+    arg_parser.add_argument('--precision', dest='precision', action='store',
+                       type=int,
+                       help='Round coordinates to this many decimals.')
+    args = arg_parser.parse_args()
+    features = geojsonio.read(args.src)
+    if args.significance:
+        geojsonio.write(args.dst, each_window(
+            features, lambda window: significance(window, args.jobs)),
+            args.precision)
+    elif args.levels:
+        root, ext = os.path.splitext(args.dst)
+        outputs = [open('%s-%s%s' % (root, tolerance, ext), 'wb')
+                   for tolerance in args.levels]
+        writers = [geojsonio.open_writer(output, args.dst, args.precision)
+                   for output in outputs]
+        for window in windows(features):
+            if not all('significance' in feature['properties']
+                       for feature in window):
+                significance(window, args.jobs)
+            for tolerance, writer in zip(args.levels, writers):
+                level = copy.deepcopy(window)
+                simplify(level, tolerance)
+                for feature in level:
+                    writer.write(feature)
+        for writer, output in zip(writers, outputs):
+            writer.close()
+            output.close()
+    else:
+        geojsonio.write(args.dst, each_window(
+            features, lambda window: simplify(window, args.tolerance,
+                                              args.jobs)),
+            args.precision)
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Persistent state of the boundaries parser2.py built, so OSM change
+files can update them without reading the source again (see parser2.py
+--state and --apply-diff).
+
+A state directory holds only what the boundaries use:
+
+    meta.json           state version, the parameters the boundaries were
+                        built with and the current files below
+    nodes-N.arr         node coordinates (sharedarray format), in layers:
+                        every update adds the nodes it created or moved,
+                        later layers winning
+    ways-N.arr          the ways of the relations
+    relations-N.json    the relations dict
+    features-N.geobin   the features, one per relation (see geobin.py)
+    feature_ids-N.arr   the relation id of every feature
+
+N is the generation of a file, the update that wrote it. An update
+writes new files next to the current ones and then replaces meta.json,
+so a failed one leaves the previous state whole. An update that would
+make more than LAYERS node layers merges them into one of the nodes the
+ways still use.
+"""
+import os
+from array import array
+import simplejson as json
+import cache
+import geobin
+import nodestore
+import sharedarray
+
+VERSION = 1
+LAYERS = 8
+# what the files of a state are called, before their generation
+FILES = ('nodes', 'ways', 'relations', 'features', 'feature_ids')
+
+
+def is_state_file(name):
+    return name == 'meta.json' or name.split('-')[0] in FILES
+
+
+class State(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def filename(self, name):
+        return os.path.join(self.directory, name)
+
+    def meta(self):
+        with open(self.filename('meta.json'), 'rb') as fileobj:
+            return json.load(fileobj)
+
+    def exists(self):
+        try:
+            meta = self.meta()
+        except (IOError, ValueError):
+            return False
+        return meta.get('version') == VERSION
+
+    def clear(self):
+        """Remove the files of the state, leaving the directory."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if is_state_file(name):
+                os.remove(self.filename(name))
+
+    def load(self):
+        """The node layers, as read-only SortedNodeStores mapping their
+        files, the ways, the relations and the parameters."""
+        meta = self.meta()
+        layers = [cache.load_nodes(self.filename(name), nodes_sorted)
+                  for name, nodes_sorted in meta['nodes']]
+        return (layers, cache.load_ways(self.filename(meta['ways'])),
+                cache.load_relations(self.filename(meta['relations'])),
+                meta['params'])
+
+    def features(self):
+        """Yield the (relation id, geobin record) of every feature."""
+        meta = self.meta()
+        ids, = sharedarray.attach(self.filename(meta['feature_ids']))
+        with open(self.filename(meta['features']), 'rb') as fileobj:
+            reader = geobin.Reader(fileobj)
+            for i, relation_id in enumerate(ids):
+                yield relation_id, reader.record(i)
+
+    def save(self, nodes, ways, relations, features, params=None,
+             replace=False):
+        """Add the node store `nodes`, unless it is empty, as a layer over
+        those of the state (a new state has none) and replace the ways and
+        relations dicts and the features, (relation id, feature, record)
+        triples where record is the feature's geobin record or None.
+        `params` replace the state's if given.
+
+        With `replace` the state starts afresh from `nodes` alone, yet the
+        previous one is only removed once the new one is complete."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        meta = {'nodes': [], 'params': {}, 'generation': 0}
+        if self.exists():
+            meta = self.meta()
+        generation = meta['generation'] + 1
+        if replace:
+            meta['nodes'] = []
+
+        def name(base, ext):
+            return '%s-%d%s' % (base, generation, ext)
+
+        node_files = meta['nodes']
+        if len(node_files) >= LAYERS:
+            nodes = self.merge_layers(node_files, nodes, ways)
+            node_files = []
+        if len(nodes) or not node_files:
+            filename = name('nodes', '.arr')
+            node_files = node_files + [
+                [filename, cache.dump_nodes(self.filename(filename), nodes)]]
+        cache.dump_ways(self.filename(name('ways', '.arr')), ways)
+        cache.dump_relations(self.filename(name('relations', '.json')),
+                             relations)
+        ids = array('l')
+        with open(self.filename(name('features', '.geobin')), 'wb') as f:
+            writer = geobin.Writer(f)
+            for relation_id, feature, record in features:
+                if record is None:
+                    writer.write(feature)
+                else:
+                    writer.write_record(record)
+                ids.append(relation_id)
+            writer.close()
+        sharedarray.dump(self.filename(name('feature_ids', '.arr')), (ids, ))
+
+        meta = {'version': VERSION, 'generation': generation,
+                'params': meta['params'] if params is None else params,
+                'nodes': node_files, 'ways': name('ways', '.arr'),
+                'relations': name('relations', '.json'),
+                'features': name('features', '.geobin'),
+                'feature_ids': name('feature_ids', '.arr')}
+        with open(self.filename('meta.json.tmp'), 'wb') as fileobj:
+            json.dump(meta, fileobj)
+        os.rename(self.filename('meta.json.tmp'), self.filename('meta.json'))
+        self.prune(meta)
+
+    def merge_layers(self, node_files, nodes, ways):
+        """One SortedNodeStore of the nodes of `ways` from the layers in
+        `node_files` and the SortedNodeStore `nodes` over them."""
+        layers = nodestore.ChainedNodeStore(
+            [cache.load_nodes(self.filename(layer), nodes_sorted)
+             for layer, nodes_sorted in node_files] + [nodes])
+        needed = set()
+        for refs in ways.itervalues():
+            needed.update(refs)
+        merged = nodestore.SortedNodeStore()
+        for node_id in sorted(needed):
+            coords = layers.get(node_id)
+            if coords is not None:
+                merged[node_id] = coords
+        return merged
+
+    def prune(self, meta):
+        """Remove the files that `meta` does not use."""
+        used = set(name for name, nodes_sorted in meta['nodes'])
+        used.update(meta[key] for key in ('ways', 'relations', 'features',
+                                          'feature_ids'))
+        for name in os.listdir(self.directory):
+            if is_state_file(name) and name != 'meta.json' and (
+                    name not in used):
+                os.remove(self.filename(name))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Expressions over the tags of OSM objects, to pick relations by.
+
+    boundary=administrative and admin_level<=4
+    (type=boundary or type=multipolygon) and not disused
+
+A key alone holds when the tag is there. key=value and key!=value
+compare the value as a string; != also holds when the tag is missing.
+<, <=, > and >= compare numbers and do not hold for a missing or non
+numeric value. Values with spaces or operator characters are quoted.
+`not` binds tighter than `and`, which binds tighter than `or`.
+
+>>> match = compile_expression('boundary=administrative and admin_level<=4')
+>>> match({'boundary': 'administrative', 'admin_level': '2'})
+True
+>>> match({'boundary': 'administrative', 'admin_level': '6'})
+False
+>>> match({'admin_level': '2'})
+False
+>>> compile_expression('name="Foo Bar" or not boundary')({'name': 'Foo Bar'})
+True
+>>> compile_expression('admin_level<=')
+Traceback (most recent call last):
+...
+ValueError: Expected a value at the end of 'admin_level<='
+"""
+import re
+
+TOKEN = re.compile(r'''\s*(?:(?P<op><=|>=|!=|=|<|>)|(?P<paren>[()])|
+                       "(?P<dquoted>[^"]*)"|'(?P<squoted>[^']*)'|
+                       (?P<word>[^\s()<>=!"']+))''', re.VERBOSE)
+KEYWORDS = ('and', 'or', 'not')
+
+
+def tokenize(expression):
+    """(kind, text) pairs: kind is 'op', 'paren', 'keyword' or 'word'
+    (quoted text is a word)."""
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = TOKEN.match(expression, pos)
+        if match is None or match.end() == pos:
+            raise ValueError("Unexpected %r in %r" % (expression[pos:],
+                                                      expression))
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind in ('dquoted', 'squoted'):
+            kind = 'word'
+        elif kind == 'word' and text in KEYWORDS:
+            kind = 'keyword'
+        tokens.append((kind, text))
+    return tokens
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def comparison(key, op, value):
+    """The test of one `key` `op` `value` comparison."""
+    if op == '=':
+        return lambda tags: tags.get(key) == value
+    if op == '!=':
+        return lambda tags: tags.get(key) != value
+    limit = number(value)
+    if limit is None:
+        raise ValueError("%s needs a number, not %r" % (op, value))
+    compare = {'<': float.__lt__, '<=': float.__le__,
+               '>': float.__gt__, '>=': float.__ge__}[op]
+
+    def test(tags):
+        tag = number(tags.get(key))
+        return tag is not None and compare(tag, limit)
+    return test
+
+
+class Parser(object):
+    """Recursive descent over the tokens of an expression, building
+    functions of the tags."""
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, kind, what):
+        token_kind, text = self.peek()
+        if token_kind != kind:
+            if token_kind is None:
+                raise ValueError("Expected %s at the end of %r"
+                                 % (what, self.expression))
+            raise ValueError("Expected %s at %r in %r"
+                             % (what, text, self.expression))
+        self.pos += 1
+        return text
+
+    def parse(self):
+        test = self.any_of()
+        if self.pos < len(self.tokens):
+            raise ValueError("Unexpected %r in %r" % (self.peek()[1],
+                                                      self.expression))
+        return test
+
+    def any_of(self):
+        tests = [self.all_of()]
+        while self.peek() == ('keyword', 'or'):
+            self.pos += 1
+            tests.append(self.all_of())
+        if len(tests) == 1:
+            return tests[0]
+        return lambda tags: any(test(tags) for test in tests)
+
+    def all_of(self):
+        tests = [self.negation()]
+        while self.peek() == ('keyword', 'and'):
+            self.pos += 1
+            tests.append(self.negation())
+        if len(tests) == 1:
+            return tests[0]
+        return lambda tags: all(test(tags) for test in tests)
+
+    def negation(self):
+        if self.peek() == ('keyword', 'not'):
+            self.pos += 1
+            test = self.negation()
+            return lambda tags: not test(tags)
+        return self.atom()
+
+    def atom(self):
+        if self.peek() == ('paren', '('):
+            self.pos += 1
+            test = self.any_of()
+            self.take('paren', "')'")
+            return test
+        key = self.take('word', 'a key')
+        if self.peek()[0] != 'op':
+            return lambda tags: key in tags
+        op = self.take('op', 'an operator')
+        return comparison(key, op, self.take('word', 'a value'))
+
+
+def compile_expression(expression):
+    """A function of a tags dict telling whether they match `expression`.
+    Raises ValueError if it is malformed."""
+    return Parser(expression).parse()
+
+
+def expression(text):
+    """`text` if it is a valid expression, for argparse's type."""
+    import argparse
+    try:
+        compile_expression(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return text
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()